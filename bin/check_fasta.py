@@ -1,17 +1,253 @@
+#!/usr/bin/env python
+# validates a fasta file and writes a JSON report
+# usage:
+# check_fasta.py -i input.fasta [-o report.json] [-a ACGTN]
+# check_fasta.py input.fasta
+#
+# reports characters outside the alphabet, records with no sequence,
+# duplicate sequence IDs, blank lines, sequence before the first header and
+# whether records are linear (one sequence line each) or wrapped, with
+# counts and the byte offsets of the first --max_offsets cases of each.
+# The file is read in large binary blocks of whole lines and every byte is
+# classified with numpy; offsets in compressed files are offsets into the
+# uncompressed data. Exits with status 1 if any problem was found.
+
 import sys
+import json
+from optparse import OptionParser
+import numpy as np
+from fasta_utils import open_input
+
+# IUPAC nucleotide codes
+DEFAULT_ALPHABET = 'ACGTURYSWKMBDHVN'
+
+def make_option_parser():
+    parser = OptionParser(usage="usage: %prog [options] filename",
+                          version="%prog 1.0")
+    parser.add_option("-i", "--input_fasta",
+                      default=None,
+                      type='string',
+                      help="input fasta (required; may also be given as the only argument)")
+    parser.add_option("-a","--alphabet",
+                      type="string",
+                      default=DEFAULT_ALPHABET,
+                      help="Allowed sequence characters, case-insensitive (default %default)",)
+    parser.add_option("-m","--max_offsets",
+                      type="int",
+                      default=100,
+                      help="Maximum number of offsets reported for each kind of problem (default %default)",)
+    parser.add_option("-b","--block_size",
+                      type="int",
+                      default=16 * 2 ** 20,
+                      help="Bytes read per block (default %default)",)
+    parser.add_option("-o","--output_fp",
+                      type="string",
+                      default=None,
+                      help="Output JSON report (default stdout)",)
+    return parser
+
+
+def read_line_chunks(input_fp, block_size):
+    """yields (byte offset, chunk) where each chunk is a run of whole lines"""
+    input_file = open_input(input_fp)
+    offset = 0
+    pending = []
+    while True:
+        block = input_file.read(block_size)
+        if not block:
+            break
+        cut = block.rfind(b'\n') + 1
+        if cut == 0:
+            # a line longer than a block
+            pending.append(block)
+            continue
+        pending.append(block[:cut])
+        chunk = b''.join(pending)
+        yield offset, chunk
+        offset += len(chunk)
+        pending = [block[cut:]]
+    input_file.close()
+    chunk = b''.join(pending)
+    if len(chunk) > 0:
+        yield offset, chunk
+
+
+def char_name(code):
+    """printable name of a byte for the report"""
+    if 32 < code < 127:
+        return chr(code)
+    return '\\x%02x' %(code)
+
+
+class FastaValidator(object):
+    """Accumulates validation counts over consecutive chunks of whole lines.
+
+    A record is a header line and the lines up to the next header; the
+    record still open at the end of a chunk is carried into the next one.
+    """
+    def __init__(self, alphabet=DEFAULT_ALPHABET, max_offsets=100):
+        self.max_offsets = max_offsets
+        self.allowed = np.zeros(256, dtype=bool)
+        for char in alphabet + alphabet.lower() + '\r\n':
+            self.allowed[ord(char)] = True
+        self.char_counts = np.zeros(256, dtype=np.int64)
+        self.bad_offsets = []
+        self.blank_lines = 0
+        self.blank_offsets = []
+        self.empty_offsets = []
+        self.no_header_offset = None
+        self.missing_id_offsets = []
+        self.seen_ids = set()
+        self.duplicates = 0
+        self.duplicate_ids = []
+        self.nrecords = 0
+        self.nbases = 0
+        self.nlinear = 0
+        self.nwrapped = 0
+        self.nempty = 0
+        self.nmissing_ids = 0
+        # [record offset, sequence lines, bases] of the record still open
+        self.current = None
+
+    def _add_offsets(self, offsets, positions):
+        room = self.max_offsets - len(offsets)
+        if room > 0:
+            offsets.extend(positions[:room].tolist())
+
+    def _finish_records(self, offsets, seq_lines, bases):
+        """adds the counts of complete records"""
+        self.nrecords += len(offsets)
+        self.nbases += int(bases.sum())
+        self.nlinear += int((seq_lines == 1).sum())
+        self.nwrapped += int((seq_lines > 1).sum())
+        empty = seq_lines == 0
+        self.nempty += int(empty.sum())
+        self._add_offsets(self.empty_offsets, offsets[empty])
+
+    def add_chunk(self, offset, chunk):
+        data = np.frombuffer(chunk, dtype=np.uint8)
+        n = len(data)
+        newlines = np.flatnonzero(data == 10)
+        starts = np.concatenate(([0], newlines + 1))
+        ends = np.concatenate((newlines, [n]))
+        if starts[-1] == n:
+            # nothing after the final newline
+            starts = starts[:-1]
+            ends = ends[:-1]
+        # line lengths without the line break
+        content_ends = ends.copy()
+        nonempty = ends > starts
+        content_ends[nonempty] -= data[ends[nonempty] - 1] == 13
+        lengths = content_ends - starts
+        is_header = (lengths > 0) & (data[np.minimum(starts, n - 1)] == 62)
+        is_blank = lengths == 0
+        is_seq = ~is_header & ~is_blank
+
+        # characters outside the alphabet, ignoring header lines
+        header_mask = np.zeros(n + 1, dtype=np.int8)
+        header_mask[starts[is_header]] = 1
+        header_mask[ends[is_header]] = -1
+        bad = ~self.allowed[data]
+        bad &= np.cumsum(header_mask[:n], dtype=np.int8) == 0
+        bad_positions = np.flatnonzero(bad)
+        self.char_counts += np.bincount(data[bad_positions], minlength=256)
+        self._add_offsets(self.bad_offsets, bad_positions + offset)
+
+        self.blank_lines += int(is_blank.sum())
+        self._add_offsets(self.blank_offsets, starts[is_blank] + offset)
+
+        # IDs need a dict lookup per record
+        header_starts = starts[is_header]
+        for start, end in zip(header_starts.tolist(), content_ends[is_header].tolist()):
+            words = chunk[start + 1:end].split()
+            if len(words) == 0:
+                self.nmissing_ids += 1
+                if len(self.missing_id_offsets) < self.max_offsets:
+                    self.missing_id_offsets.append(start + offset)
+                continue
+            seq_id = words[0]
+            if seq_id in self.seen_ids:
+                self.duplicates += 1
+                if len(self.duplicate_ids) < self.max_offsets:
+                    self.duplicate_ids.append({'id': seq_id.decode('latin-1'), 'offset': start + offset})
+            else:
+                self.seen_ids.add(seq_id)
+
+        # line counts and bases per record; record 0 is the one carried in
+        nheaders = len(header_starts)
+        line_records = np.cumsum(is_header)
+        seq_lines = np.bincount(line_records[is_seq], minlength=nheaders + 1)
+        bases = np.bincount(line_records[is_seq], weights=lengths[is_seq],
+                            minlength=nheaders + 1).astype(np.int64)
+        if self.current is None:
+            if seq_lines[0] > 0 and self.no_header_offset is None:
+                self.no_header_offset = int(starts[np.flatnonzero(is_seq)[0]]) + offset
+        else:
+            self.current[1] += seq_lines[0]
+            self.current[2] += bases[0]
+        if nheaders == 0:
+            return
+        record_offsets = header_starts + offset
+        if self.current is not None:
+            self._finish_records(np.array([self.current[0]]), np.array([self.current[1]]),
+                                 np.array([self.current[2]]))
+        self._finish_records(record_offsets[:-1], seq_lines[1:-1], bases[1:-1])
+        self.current = [int(record_offsets[-1]), int(seq_lines[-1]), int(bases[-1])]
+
+    def report(self):
+        """closes the last record and returns the report as a dict"""
+        if self.current is not None:
+            self._finish_records(np.array([self.current[0]]), np.array([self.current[1]]),
+                                 np.array([self.current[2]]))
+            self.current = None
+        if self.nrecords == 0:
+            layout = 'empty'
+        elif self.nwrapped == 0:
+            layout = 'linear'
+        elif self.nlinear == 0:
+            layout = 'wrapped'
+        else:
+            layout = 'mixed'
+        bad_chars = dict([(char_name(code), int(count))
+                          for code, count in enumerate(self.char_counts.tolist()) if count > 0])
+        nbad = int(self.char_counts.sum())
+        valid = (nbad == 0 and self.nempty == 0 and self.duplicates == 0 and self.blank_lines == 0
+                 and self.nmissing_ids == 0 and self.no_header_offset is None)
+        return {'valid': valid,
+                'records': self.nrecords,
+                'bases': self.nbases,
+                'layout': layout,
+                'linear_records': self.nlinear,
+                'wrapped_records': self.nwrapped,
+                'bad_characters': {'count': nbad, 'chars': bad_chars, 'offsets': self.bad_offsets},
+                'empty_records': {'count': self.nempty, 'offsets': self.empty_offsets},
+                'duplicate_ids': {'count': self.duplicates, 'ids': self.duplicate_ids},
+                'missing_ids': {'count': self.nmissing_ids, 'offsets': self.missing_id_offsets},
+                'blank_lines': {'count': self.blank_lines, 'offsets': self.blank_offsets},
+                'sequence_before_first_header': self.no_header_offset}
+
+
+if __name__ == '__main__':
+    parser = make_option_parser()
+    (options, args) = parser.parse_args()
+    if options.input_fasta is None and len(args) == 1:
+        options.input_fasta = args[0]
+    if options.input_fasta is None:
+        raise ValueError('Please supply --input_fasta')
+
+    validator = FastaValidator(options.alphabet, options.max_offsets)
+    for offset, chunk in read_line_chunks(options.input_fasta, options.block_size):
+        validator.add_chunk(offset, chunk)
+    report = validator.report()
+    report['input'] = options.input_fasta
 
-count = 0
-prevline = '' 
-prevprevline = ''
-for line in open(sys.argv[1],'r'):
-    line = line.strip()
-    if count % 2 == 0 and not line.startswith('>'):
-        print("Line ",count, "\n")
-        print(prevprevline)
-        print(prevline)
-        print(line)
-        sys.exit(0)
+    if options.output_fp is not None:
+        output_file = open(options.output_fp, 'w')
     else:
-        count += 1
-        prevprevline = prevline
-        prevline = line
+        output_file = sys.stdout
+    json.dump(report, output_file, indent=2, sort_keys=True, separators=(',', ': '))
+    output_file.write('\n')
+    if options.output_fp is not None:
+        output_file.close()
+    if not report['valid']:
+        sys.exit(1)
@@ -0,0 +1,630 @@
+# streaming fasta reader shared by the scripts in bin/
+#
+# files are read in large binary blocks and split into records on '\n>',
+# so a wrapped sequence costs one join per record instead of one string
+# append per line. Headers are returned without the leading '>' and
+# sequences with all line breaks and whitespace removed.
+# record_spans finds the records of a read-only mmap of the file without
+# copying it, for the .fai index.
+#
+# paths ending in .gz, .bz2 or .zst are decompressed (and outputs
+# compressed) on the fly, in a gzip/bzip2/zstd subprocess when one is on
+# the PATH and otherwise in a thread, either way behind a bounded buffer.
+# Compressed files cannot be mmap'd or split into byte ranges, so they are
+# always read as a single stream.
+
+import os
+import io
+import mmap
+import signal
+import threading
+from collections import OrderedDict
+from subprocess import Popen, PIPE
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+BLOCK_SIZE = 4 * 2 ** 20
+CODEC_BLOCK_SIZE = 2 ** 20
+CODEC_QUEUE_BLOCKS = 16
+
+# compression commands in order of preference; the parallel ones first
+CODEC_COMMANDS = {'.gz': [['pigz'], ['gzip']],
+                  '.bz2': [['pbzip2'], ['bzip2']],
+                  '.zst': [['zstd', '-q']]}
+
+
+def compression_ext(fp):
+    """'.gz', '.bz2' or '.zst' if fp names a compressed file, else None"""
+    ext = os.path.splitext(fp)[1].lower()
+    if ext in CODEC_COMMANDS:
+        return ext
+    return None
+
+
+def strip_compression_ext(fp):
+    """fp without its compression extension, if any"""
+    if compression_ext(fp) is not None:
+        return os.path.splitext(fp)[0]
+    return fp
+
+
+def parse_memory(mem):
+    """bytes in a memory size like '16gb', '500mb', '100kb' or '1000000'"""
+    units = {'kb':2 ** 10, 'mb':2 ** 20, 'gb':2 ** 30, 'tb':2 ** 40}
+    mem = mem.strip().lower()
+    if mem[-2:] in units:
+        return int(float(mem[:-2]) * units[mem[-2:]])
+    return int(mem)
+
+
+def _find_command(ext):
+    """first compression command for ext that is on the PATH, or None"""
+    for command in CODEC_COMMANDS[ext]:
+        for path in os.environ.get('PATH', '').split(os.pathsep):
+            if os.access(os.path.join(path, command[0]), os.X_OK):
+                return command
+    return None
+
+
+def _import_zstandard(fp):
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError('Reading or writing %s needs the zstd command or the zstandard module' %(fp))
+    return zstandard
+
+
+class _Bz2Reader(object):
+    """Decompresses every bzip2 stream in a raw file, not just the first
+    (python 2's BZ2File stops after one)."""
+    def __init__(self, raw_file):
+        import bz2
+        self.bz2 = bz2
+        self.raw_file = raw_file
+        self.decompressor = bz2.BZ2Decompressor()
+        self.pending = b''
+
+    def read(self, size):
+        while True:
+            block = self.pending or self.raw_file.read(size)
+            self.pending = b''
+            if not block:
+                return b''
+            try:
+                data = self.decompressor.decompress(block)
+            except EOFError:
+                # the last stream ended exactly at the end of a block
+                self.decompressor = self.bz2.BZ2Decompressor()
+                data = self.decompressor.decompress(block)
+            if self.decompressor.unused_data:
+                self.pending = self.decompressor.unused_data
+                self.decompressor = self.bz2.BZ2Decompressor()
+            if data:
+                return data
+
+    def close(self):
+        self.raw_file.close()
+
+
+def _codec_module_reader(fp, ext):
+    """python file object that decompresses fp, for when there is no command"""
+    if ext == '.gz':
+        import gzip
+        return gzip.open(fp, 'rb')
+    if ext == '.bz2':
+        return _Bz2Reader(open(fp, 'rb'))
+    return _import_zstandard(fp).ZstdDecompressor().stream_reader(open(fp, 'rb'))
+
+
+class _CompressorFile(object):
+    """Writes data through a compress()/flush() object into a raw file."""
+    def __init__(self, raw_file, compressor):
+        self.raw_file = raw_file
+        self.compressor = compressor
+
+    def write(self, data):
+        self.raw_file.write(self.compressor.compress(data))
+
+    def close(self):
+        self.raw_file.write(self.compressor.flush())
+        self.raw_file.close()
+
+
+def _codec_module_writer(fp, ext, mode):
+    """python file object that compresses into fp, for when there is no command
+
+    Appending adds a new gzip member, bzip2 stream or zstd frame, which
+    all three formats read back as one continuous file.
+    """
+    if ext == '.gz':
+        import zlib
+        # wbits 31 writes a gzip header and trailer
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    elif ext == '.bz2':
+        import bz2
+        compressor = bz2.BZ2Compressor()
+    else:
+        compressor = _import_zstandard(fp).ZstdCompressor().compressobj()
+    return _CompressorFile(open(fp, mode), compressor)
+
+
+def _restore_sigpipe():
+    # lets a decompressor whose reader stopped early exit quietly
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+
+class _CodecPipe(object):
+    """One end of a compression subprocess; close() waits for it to finish."""
+    def __init__(self, proc, pipe, fp):
+        self.proc = proc
+        self.pipe = pipe
+        self.fp = fp
+
+    def __getattr__(self, name):
+        return getattr(self.pipe, name)
+
+    def __iter__(self):
+        return iter(self.pipe)
+
+    def close(self):
+        if self.pipe.closed:
+            return
+        self.pipe.close()
+        ret = self.proc.wait()
+        if ret != 0 and ret != -signal.SIGPIPE:
+            raise IOError('Compression command failed on %s' %(self.fp))
+
+
+class _ThreadedReader(io.RawIOBase):
+    """Decompresses in a thread into a queue of at most CODEC_QUEUE_BLOCKS blocks."""
+    def __init__(self, codec_file):
+        self.codec_file = codec_file
+        self.queue = Queue(CODEC_QUEUE_BLOCKS)
+        self.block = b''
+        self.done = False
+        self.stopped = False
+        self.thread = threading.Thread(target=self._fill)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _fill(self):
+        try:
+            while not self.stopped:
+                block = self.codec_file.read(CODEC_BLOCK_SIZE)
+                self.queue.put(block)
+                if not block:
+                    break
+        except Exception as e:
+            self.queue.put(e)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if len(self.block) == 0:
+            if self.done:
+                return 0
+            block = self.queue.get()
+            if isinstance(block, Exception):
+                raise block
+            if not block:
+                self.done = True
+                return 0
+            self.block = block
+        n = min(len(b), len(self.block))
+        b[:n] = self.block[:n]
+        self.block = self.block[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            # stop the thread, emptying the queue in case it is waiting on it
+            self.stopped = True
+            while self.thread.is_alive():
+                try:
+                    self.queue.get(timeout=0.1)
+                except Empty:
+                    pass
+            self.codec_file.close()
+            io.RawIOBase.close(self)
+
+
+class _ThreadedWriter(io.RawIOBase):
+    """Compresses in a thread fed by a queue of at most CODEC_QUEUE_BLOCKS blocks."""
+    def __init__(self, codec_file):
+        self.codec_file = codec_file
+        self.queue = Queue(CODEC_QUEUE_BLOCKS)
+        self.error = None
+        self.thread = threading.Thread(target=self._drain)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _drain(self):
+        try:
+            while True:
+                block = self.queue.get()
+                if block is None:
+                    break
+                self.codec_file.write(block)
+            self.codec_file.close()
+        except Exception as e:
+            self.error = e
+            # keep taking blocks so the writer is never stuck on a full queue
+            while block is not None:
+                block = self.queue.get()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(memoryview(b).tobytes())
+        return len(b)
+
+    def close(self):
+        if not self.closed:
+            self.queue.put(None)
+            self.thread.join()
+            io.RawIOBase.close(self)
+            if self.error is not None:
+                raise self.error
+
+
+def open_input(input_fp):
+    """binary file object for reading a plain, .gz, .bz2 or .zst file"""
+    ext = compression_ext(input_fp)
+    if ext is None:
+        return open(input_fp, 'rb')
+    if not os.path.exists(input_fp):
+        raise IOError('No such file: %s' %(input_fp))
+    command = _find_command(ext)
+    if command is not None:
+        proc = Popen(command + ['-dc', input_fp], stdout=PIPE, bufsize=CODEC_BLOCK_SIZE,
+                     preexec_fn=_restore_sigpipe)
+        return _CodecPipe(proc, proc.stdout, input_fp)
+    return io.BufferedReader(_ThreadedReader(_codec_module_reader(input_fp, ext)), CODEC_BLOCK_SIZE)
+
+
+def open_output(output_fp, append=False):
+    """file object for writing (or appending to) a plain, .gz, .bz2 or .zst file"""
+    mode = 'wb'
+    if append:
+        mode = 'ab'
+    ext = compression_ext(output_fp)
+    if ext is None:
+        return open(output_fp, mode)
+    command = _find_command(ext)
+    if command is not None:
+        output_file = open(output_fp, mode)
+        proc = Popen(command + ['-c'], stdin=PIPE, stdout=output_file, bufsize=CODEC_BLOCK_SIZE)
+        output_file.close()
+        return _CodecPipe(proc, proc.stdin, output_fp)
+    return io.BufferedWriter(_ThreadedWriter(_codec_module_writer(output_fp, ext, mode)), CODEC_BLOCK_SIZE)
+
+
+class WriterPool(object):
+    """Buffered writers for many output files, e.g. one per group or region.
+
+    Text written to each key is buffered in memory and flushed, one join
+    and write per file, whenever all buffers together reach buffer_size.
+    At most max_open files are kept open; the least recently flushed one is
+    closed to make room and reopened for appending when needed again.
+    """
+    def __init__(self, output_fps, buffer_size=64 * 2 ** 20, max_open=64):
+        self.output_fps = output_fps
+        self.buffer_size = buffer_size
+        self.max_open = max_open
+        self.buffers = {}
+        self.nbytes = 0
+        self.files = OrderedDict()
+        self.started = set()
+
+    def write(self, key, text):
+        """buffers text for the output file of key"""
+        if key not in self.buffers:
+            self.buffers[key] = []
+        self.buffers[key].append(text)
+        self.nbytes += len(text)
+        if self.nbytes >= self.buffer_size:
+            self.flush()
+
+    def _file(self, key):
+        if key in self.files:
+            output_file = self.files.pop(key)
+        else:
+            if len(self.files) >= self.max_open:
+                self.files.popitem(last=False)[1].close()
+            output_file = open_output(self.output_fps[key], append=key in self.started)
+            self.started.add(key)
+        self.files[key] = output_file
+        return output_file
+
+    def flush(self):
+        for key in sorted(self.buffers):
+            self._file(key).write(b''.join(self.buffers[key]))
+        self.buffers = {}
+        self.nbytes = 0
+
+    def close(self):
+        self.flush()
+        for output_file in self.files.values():
+            output_file.close()
+        self.files = OrderedDict()
+
+
+def _open_binary(input_fp):
+    """(binary file, whether we opened it) for a path or an open file"""
+    if hasattr(input_fp, 'read'):
+        return getattr(input_fp, 'buffer', input_fp), False
+    return open_input(input_fp), True
+
+
+def _parse_record(record):
+    """(header, seq) from the text of one record, with or without its '>'"""
+    if record[:1] == b'>':
+        record = record[1:]
+    nl = record.find(b'\n')
+    if nl < 0:
+        return record.rstrip(), b''
+    return record[:nl].rstrip(), b''.join(record[nl + 1:].split())
+
+
+def read_fasta(input_fp, start=0, end=None, block_size=BLOCK_SIZE):
+    """yields (header, seq) for each record of a fasta file or open file
+
+    Only the bytes in [start, end) are read; start must be the start of a
+    record and end the start of a record or the end of the file, as given
+    by record_aligned_ranges.
+    """
+    input_file, opened = _open_binary(input_fp)
+    if start > 0:
+        input_file.seek(start)
+    remaining = None
+    if end is not None:
+        remaining = end - start
+    # pieces of the last, still incomplete record
+    pending = []
+    while remaining is None or remaining > 0:
+        size = block_size
+        if remaining is not None:
+            size = min(size, remaining)
+            remaining -= size
+        block = input_file.read(size)
+        if not block:
+            break
+        # most blocks of a long record contain no record boundary at all
+        if block.find(b'\n>') < 0 and not (block[:1] == b'>' and pending and pending[-1][-1:] == b'\n'):
+            pending.append(block)
+            continue
+        pending.append(block)
+        records = b''.join(pending).split(b'\n>')
+        pending = [records.pop()]
+        for record in records:
+            yield _parse_record(record)
+    if opened:
+        input_file.close()
+    record = b''.join(pending)
+    if len(record.strip()) > 0:
+        yield _parse_record(record)
+
+
+def read_record_chunks(input_fp, nrecords, start=0, end=None, block_size=BLOCK_SIZE):
+    """yields (text, number of records, end offset) for runs of nrecords records
+
+    The text of each run is copied from the input unchanged, wrapping and
+    all, so it is a valid fasta file in itself. The end offset is the byte
+    offset just past the run in the (uncompressed) input. nrecords may also
+    be a function of the run's number returning its number of records.
+    Only the bytes in [start, end) are read, as for read_fasta.
+    """
+    if callable(nrecords):
+        run_size = nrecords
+    else:
+        run_size = lambda index: nrecords
+    input_file, opened = _open_binary(input_fp)
+    if start > 0:
+        input_file.seek(start)
+    remaining = None
+    if end is not None:
+        remaining = end - start
+    pieces = []
+    count = 0
+    offset = start
+    index = 0
+    size = run_size(index)
+    # byte before the block; start is always a line start
+    last = b'\n'
+    while remaining is None or remaining > 0:
+        read_size = block_size
+        if remaining is not None:
+            read_size = min(read_size, remaining)
+            remaining -= read_size
+        block = input_file.read(read_size)
+        if not block:
+            break
+        cut = 0
+        if last == b'\n' and block[:1] == b'>':
+            rs = 0
+        else:
+            rs = block.find(b'\n>')
+            if rs >= 0:
+                rs += 1
+        while rs >= 0:
+            if count == size:
+                pieces.append(block[cut:rs])
+                text = b''.join(pieces)
+                offset += len(text)
+                yield text, count, offset
+                pieces = []
+                count = 0
+                cut = rs
+                index += 1
+                size = run_size(index)
+            count += 1
+            rs = block.find(b'\n>', rs)
+            if rs >= 0:
+                rs += 1
+        pieces.append(block[cut:])
+        last = block[-1:]
+    if opened:
+        input_file.close()
+    text = b''.join(pieces)
+    if count > 0:
+        yield text, count, offset + len(text)
+
+
+def open_mmap(input_fp):
+    """read-only mmap of a file (an empty string for an empty file)"""
+    if compression_ext(input_fp) is not None:
+        raise ValueError('Cannot mmap compressed file %s' %(input_fp))
+    if os.path.getsize(input_fp) == 0:
+        return b''
+    input_file = open(input_fp, 'rb')
+    data = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+    input_file.close()
+    return data
+
+
+def record_spans(data, start=0, end=None):
+    """yields (record start, sequence start, record end) byte offsets
+
+    data is a string or mmap holding fasta text and start must be the start
+    of a record. The sequence bytes data[sequence start:record end] still
+    contain their line breaks, including the final one.
+    """
+    if end is None:
+        end = len(data)
+    pos = start
+    while pos < end:
+        nl = data.find(b'\n', pos, end)
+        if nl < 0:
+            yield pos, end, end
+            break
+        next_pos = data.find(b'\n>', nl, end)
+        if next_pos < 0:
+            next_pos = end
+        else:
+            next_pos += 1
+        yield pos, nl + 1, next_pos
+        pos = next_pos
+
+
+def record_aligned_ranges(input_fp, n):
+    """splits a fasta file into up to n byte ranges that each start at a header
+
+    A compressed file is a single range, (0, None).
+    """
+    if compression_ext(input_fp) is not None:
+        return [(0, None)]
+    size = os.path.getsize(input_fp)
+    input_file = open(input_fp, 'rb')
+    starts = [0]
+    for i in range(1, n):
+        pos = size * i // n
+        if pos <= starts[-1]:
+            continue
+        # skip the partial line, then move on to the next header
+        input_file.seek(pos)
+        pos += len(input_file.readline())
+        while True:
+            line = input_file.readline()
+            if not line or line.startswith(b'>'):
+                break
+            pos += len(line)
+        if pos < size and pos > starts[-1]:
+            starts.append(pos)
+    input_file.close()
+    return list(zip(starts, starts[1:] + [size]))
+
+
+def fasta_index_path(input_fp):
+    """path of the .fai index sidecar of a fasta file"""
+    return input_fp + '.fai'
+
+
+def build_fasta_index(input_fp, index_fp=None):
+    """writes a samtools-style .fai index of a fasta file and returns its path
+
+    Each line is sequence ID (first word of the header), sequence length,
+    byte offset of the sequence, bases per line and bytes per line.
+    """
+    if index_fp is None:
+        index_fp = fasta_index_path(input_fp)
+    data = open_mmap(input_fp)
+    index_file = open(index_fp, 'wb')
+    lines = []
+    for record_start, seq_start, record_end in record_spans(data):
+        words = data[record_start + 1:seq_start].split()
+        seq_id = words[0] if len(words) > 0 else b''
+        seq_lines = data[seq_start:record_end].split(b'\n')
+        length = sum([len(line.rstrip()) for line in seq_lines])
+        line_bases = len(seq_lines[0].rstrip())
+        line_width = len(seq_lines[0]) + 1
+        lines.append(b'%s\t%d\t%d\t%d\t%d\n' %(seq_id, length, seq_start, line_bases, line_width))
+        if len(lines) >= 100000:
+            index_file.write(b''.join(lines))
+            lines = []
+    index_file.write(b''.join(lines))
+    index_file.close()
+    return index_fp
+
+
+def has_fasta_index(input_fp):
+    """True if input_fp has a .fai index that is no older than the file"""
+    index_fp = fasta_index_path(input_fp)
+    if compression_ext(input_fp) is not None:
+        return False
+    return os.path.exists(index_fp) and os.path.getmtime(index_fp) >= os.path.getmtime(input_fp)
+
+
+class FastaIndex(object):
+    """Random access to the records of a fasta file through its .fai index.
+
+    Records are read by seeking into a read-only mmap of the file, so only
+    the index and the requested records are touched.
+    """
+    def __init__(self, input_fp, index_fp=None):
+        if index_fp is None:
+            index_fp = fasta_index_path(input_fp)
+        self.input_fp = input_fp
+        self.data = open_mmap(input_fp)
+        # (ID, length, sequence offset) in file order
+        self.entries = []
+        for line in open(index_fp, 'rb'):
+            words = line.rstrip(b'\n').split(b'\t')
+            self.entries.append((words[0], int(words[1]), int(words[2])))
+        self.offsets = {}
+        for seq_id, length, offset in reversed(self.entries):
+            self.offsets[seq_id] = offset
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, seq_id):
+        return seq_id in self.offsets
+
+    def ids(self):
+        """sequence IDs in file order"""
+        return [seq_id for seq_id, length, offset in self.entries]
+
+    def record_at(self, offset):
+        """(header, seq) of the record whose sequence starts at offset"""
+        header_start = self.data.rfind(b'\n', 0, offset - 1) + 1
+        header = self.data[header_start + 1:offset].rstrip()
+        seq_end = self.data.find(b'\n>', offset - 1)
+        if seq_end < 0:
+            seq_end = len(self.data)
+        return header, b''.join(self.data[offset:seq_end].split())
+
+    def fetch(self, seq_id):
+        """(header, seq) of the first record with this ID"""
+        return self.record_at(self.offsets[seq_id])
+
+    def fetch_all(self, keep):
+        """yields (header, seq) in file order for every record whose ID passes keep(seq_id)"""
+        for seq_id, length, offset in self.entries:
+            if keep(seq_id):
+                yield self.record_at(offset)
@@ -1,10 +1,24 @@
 #!/usr/bin/env python
 # usage:
 # python filter_img_fasta_by_taxon_id -i input.fasta -f taxon_id_file -o output.fasta
+# python filter_img_fasta_by_taxon_id -i input.fasta -g taxon_groups.txt -d output_dir -s .fasta.gz
+# input and output may be compressed (.gz, .bz2 or .zst)
+#
+# with --group_file (lines of taxon ID<tab>group), the input is split into
+# one output_dir/<group><suffix> file per group in a single pass
+#
+# with --processes, record-aligned byte ranges of the input are filtered in
+# parallel into part files that are concatenated in input order, so the
+# output is identical to a serial run
 
 import sys
 import os
+import shutil
+import tempfile
+import multiprocessing
 from optparse import OptionParser
+from fasta_utils import read_fasta, has_fasta_index, FastaIndex, open_output, WriterPool
+from fasta_utils import record_aligned_ranges
 
 def make_option_parser():
     parser = OptionParser(usage="usage: %prog [options] filename",
@@ -21,6 +35,30 @@ def make_option_parser():
                       default=None,
                       type='string',
                       help="Comma-delimited list of taxon IDs to extract (this or taxon_id_file required)",)
+    parser.add_option("-g","--group_file",
+                      default=None,
+                      type='string',
+                      help="Tab-delimited file of taxon ID and output group; writes one fasta per group instead of --output_fasta",)
+    parser.add_option("-d","--output_dir",
+                      default='.',
+                      type='string',
+                      help="Output directory for --group_file (default %default)",)
+    parser.add_option("-s","--output_suffix",
+                      default='.fasta',
+                      type='string',
+                      help="Suffix of the per-group output files, e.g. .fasta.gz (default %default)",)
+    parser.add_option("--max_open_files",
+                      default=64,
+                      type='int',
+                      help="Maximum number of per-group output files open at once (default %default)",)
+    parser.add_option("-p","--processes",
+                      default=1,
+                      type='int',
+                      help="Number of worker processes, each filtering one byte range of the input (default %default)",)
+    parser.add_option("--temp_dir",
+                      default=None,
+                      type='string',
+                      help="Directory for the per-process output parts (default system temp dir)",)
     parser.add_option("-v","--verbose",
                       action="store_true",
                       default=False,
@@ -28,43 +66,134 @@ def make_option_parser():
     parser.add_option("-o","--output_fasta",
                       type="string",
                       default=None,
-                      help="Output filename (required)",)
+                      help="Output filename (required unless --group_file is given)",)
     return parser
 
+
+def load_groups(group_fp):
+    """{taxon ID: [group, ...]} from lines of taxon ID<tab>group"""
+    groups = {}
+    for line in open(group_fp,'U'):
+        words = line.strip().split('\t')
+        if len(words) < 2 or words[0].startswith('#'):
+            continue
+        groups.setdefault(words[0], []).append(words[1])
+    return groups
+
+
+def header_taxon_id(header):
+    """taxon ID of an IMG header: the part of its first word before the first
+    '_', or the whole first word if it has no '_'"""
+    words = header.split(None, 1)
+    if len(words) == 0:
+        return ''
+    return words[0].split('_', 1)[0]
+
+
+def filter_records(records, taxon_ids, groups, writers, verbose=False):
+    """writes the records of the requested taxa to writers
+
+    Without groups every record goes to key None, otherwise to each of its
+    taxon's groups.
+    """
+    count = 0
+    for header, seq in records:
+        count += 1
+        if verbose and count % 100000 == 0:
+            print count
+        taxon_id = header_taxon_id(header)
+        if taxon_id in taxon_ids:
+            record = '>' + header + '\n' + seq + '\n'
+            if groups is None:
+                writers.write(None, record)
+            else:
+                for group in groups[taxon_id]:
+                    writers.write(group, record)
+
+
+def filter_range(args):
+    """Pool worker: filters one byte range of the input into uncompressed part
+    files, one per output; returns {output key: part path} for the outputs
+    that received records"""
+    input_fp, start, end, taxon_ids, groups, keys, part_fp, max_open = args
+    part_fps = dict([(key, '%s_%04d' %(part_fp, i)) for i, key in enumerate(keys)])
+    writers = WriterPool(part_fps, max_open=max_open)
+    filter_records(read_fasta(input_fp, start, end), taxon_ids, groups, writers)
+    writers.close()
+    return dict([(key, part_fps[key]) for key in writers.started])
+
+
 if __name__ == '__main__':
     parser = make_option_parser()
     (options, args) = parser.parse_args()
     
     # load ids
-    if options.taxon_ids is not None:
-        taxon_ids = options.taxon_ids.split(',')
+    groups = None
+    if options.group_file is not None:
+        groups = load_groups(options.group_file)
+        taxon_ids = set(groups)
+    elif options.taxon_ids is not None:
+        taxon_ids = set(options.taxon_ids.split(','))
     elif options.taxon_id_file is not None:
-        taxon_ids = [line.strip() for line in open(options.taxon_id_file,'U')]
+        taxon_ids = set([line.strip() for line in open(options.taxon_id_file,'U')])
     else:
-        raise ValueError('Please supply --taxon_id_file or --taxon_ids')
+        raise ValueError('Please supply --taxon_id_file, --taxon_ids or --group_file')
 
-    # read through fasta, printing only requested seqs
-    output_file = open(options.output_fasta,'w')
+    # one output per group, or a single output under key None
+    if groups is None:
+        output_fps = {None: options.output_fasta}
+    else:
+        if not os.path.isdir(options.output_dir):
+            os.makedirs(options.output_dir)
+        output_fps = {}
+        for taxon_groups in groups.values():
+            for group in taxon_groups:
+                output_fps[group] = os.path.join(options.output_dir, group + options.output_suffix)
 
-    count = 0
+    ranges = record_aligned_ranges(options.input_fasta, options.processes)
+    if has_fasta_index(options.input_fasta):
+        # with an up-to-date .fai index, only the requested records are read
+        records = FastaIndex(options.input_fasta).fetch_all(
+            lambda seq_id: header_taxon_id(seq_id) in taxon_ids)
+        ranges = None
+    elif len(ranges) == 1:
+        records = read_fasta(options.input_fasta)
+        ranges = None
 
-    include = False
-    first_seq = True
-    for line in open(options.input_fasta,'U'):
-        if line.startswith('>'):
-            count += 1
-            if options.verbose and count % 100000 == 0:
-                print count
-            taxon_id = line[1:line.find('_')]
-            if taxon_id in taxon_ids:
-                if not first_seq:
-                    output_file.write('\n')
-                first_seq = False
-                output_file.write(line.strip() + '\n')
-                include = True
-            else:
-                include = False
-        else:
-            if include:
-                output_file.write(line.strip())
-    output_file.write('\n')
+    if ranges is None:
+        writers = WriterPool(output_fps, max_open=options.max_open_files)
+        filter_records(records, taxon_ids, groups, writers, options.verbose)
+        writers.close()
+        written = writers.started
+    else:
+        keys = sorted(output_fps)
+        temp_dir = tempfile.mkdtemp(prefix='filter_', dir=options.temp_dir)
+        pool = multiprocessing.Pool(options.processes)
+        try:
+            jobs = [(options.input_fasta, start, end, taxon_ids, groups, keys,
+                     os.path.join(temp_dir, 'part%04d' %(i)), options.max_open_files)
+                    for i, (start, end) in enumerate(ranges)]
+            shard_part_fps = pool.map(filter_range, jobs)
+            written = set()
+            # concatenate each output's parts in input order
+            for key in keys:
+                part_fps = [part_fps[key] for part_fps in shard_part_fps if key in part_fps]
+                if len(part_fps) == 0:
+                    continue
+                written.add(key)
+                output_file = open_output(output_fps[key])
+                for part_fp in part_fps:
+                    part_file = open(part_fp,'rb')
+                    shutil.copyfileobj(part_file, output_file)
+                    part_file.close()
+                    os.remove(part_fp)
+                output_file.close()
+        finally:
+            pool.close()
+            pool.join()
+            shutil.rmtree(temp_dir)
+
+    # outputs that received no records are still created, empty
+    for key in output_fps:
+        if key not in written:
+            open_output(output_fps[key]).close()
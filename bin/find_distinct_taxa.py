@@ -2,9 +2,14 @@
 # find_distinct_taxa.py otu_by_otu_matches.txt taxonomy outfile.txt
 # output (tab-delimited):
 # taxonomy fraction unique, number unique, number recovered, number in database
+# otu_by_otu_matches.txt may be compressed (.gz, .bz2 or .zst), or be a hit
+# table directory written by parallel_usearch.py --columnar, of which only
+# the query and target columns are read
 #
 import sys, os
 from optparse import OptionParser
+from fasta_utils import open_input, strip_compression_ext
+from hit_table import HitTable, is_hit_table
 
 def make_option_parser():
     parser = OptionParser(usage="usage: %prog [options] filename",
@@ -35,6 +40,20 @@ def make_option_parser():
                       help="Path to output directory [default %default]")
     return parser
 
+def read_match_pairs(input_fp):
+    """yields the (query, ref) IDs of each match: the first words of the first
+    two columns of a text table, or the labels of a hit table"""
+    if is_hit_table(input_fp):
+        table = HitTable(input_fp)
+        query_ids = [label.split()[0] for label in table.labels('query')]
+        ref_ids = [label.split()[0] for label in table.labels('target')]
+        for query, ref in zip(table.column('query').tolist(), table.column('target').tolist()):
+            yield query_ids[query], ref_ids[ref]
+        return
+    for line in open_input(input_fp):
+        words = line.split('\t')
+        yield words[0].split()[0], words[1].split()[0]
+
 
 if __name__ == '__main__':
     parser = make_option_parser()
@@ -81,10 +100,7 @@ if __name__ == '__main__':
     # add it to the ambiguous list
     best_labels = {} # {taxon_ID:consensus taxonomy, ...}
     
-    for line in open(options.input_fp,'U'):
-        words = line.split('\t')
-        query = words[0].split()[0]
-        ref = words[1].split()[0]
+    for query, ref in read_match_pairs(options.input_fp):
         consensus = os.path.commonprefix([])
 
         # set this query's taxonomy to the most specific consensus
@@ -113,7 +129,7 @@ if __name__ == '__main__':
         if len(taxonomy) == len(full_taxonomy):
             species_counts[full_taxonomy_str][0] += 1
 
-    output_fp_base = os.path.splitext(os.path.basename(options.input_fp))[0]
+    output_fp_base = os.path.splitext(os.path.basename(strip_compression_ext(options.input_fp)))[0]
     output_fp_base = os.path.join(options.output_dir,output_fp_base)
     output_fp_taxa = output_fp_base + '-taxa.txt'
     output_fp_species = output_fp_base + '-species-resolution.txt'
@@ -1,11 +1,28 @@
 # kmer count for a fasta file
 # counts number of unique kmers of size k in a fasta file
+# kmers are packed 2 bits per base; kmers containing anything other than
+# ACGT (e.g. N) are skipped, and lowercase bases are counted as uppercase
 # usage:
 # get_kmers_from_fasta.py -i input.fasta -k 65 -o input_kmers_65.fasta
+# get_kmers_from_fasta.py -i input.fasta -k 31 -t sparse_table -o input_kmers_31.npz
+# get_kmers_from_fasta.py -i input.fasta -k 31 -t hll -e 0.01 --save_sketch input_hll_31.npz
+# get_kmers_from_fasta.py -i input.fasta -k 21 -t minhash -o sample_distances.txt
+# get_kmers_from_fasta.py -i input.fasta -k 21,31,65 -t table -o kmers.txt  (writes kmers_k21.txt, ...)
+# get_kmers_from_fasta.py -i input.fasta.gz -k 31 -t table -o kmers.txt.gz
+# inputs and text outputs ending in .gz, .bz2 or .zst are (de)compressed on the fly
 
 import sys
 import os
+import shutil
+import tempfile
+import multiprocessing
+import zipfile
 from optparse import OptionParser
+import numpy as np
+from kmer_utils import encode_seqs, batch_kmers, decode_kmers, KmerCounter, SampleKmerCounter
+from kmer_utils import unique_counts, pairs_to_csr, prefix_histogram, prefix_ranges, split_by_prefix
+from kmer_sketches import HyperLogLog, CountMinSketch, SampleMinHash, load_sketch
+from fasta_utils import read_fasta, record_aligned_ranges, open_output, strip_compression_ext, parse_memory
 
 def make_option_parser():
     parser = OptionParser(usage="usage: %prog [options] filename",
@@ -16,15 +33,22 @@ def make_option_parser():
                       help="input fasta (required)")
     parser.add_option("-k", "--kmer_size",
                       default=None,
-                      type='int',
-                      help="Length of kmers (required)")
+                      type='string',
+                      help=("Length of kmers, or a comma-separated list of lengths to count in one pass, "
+                            "e.g. 21,31,65; each length gets its own output, with _k<length> added to the "
+                            "output filename (required)"))
     parser.add_option("-t","--output_type",
                       type='string',
                       default='sample_table',
-                      help=("Output type: fasta, text, sample_table, table, count."
+                      help=("Output type: fasta, text, sample_table, sparse_table, table, count, hll, cms, minhash."
                       		"'sample_table' means a table of counts for each sample, assuming QIIME-style fasta headers; "
+                      		"'sparse_table' is the same table as a scipy-compatible CSR .npz file (kmers x samples) "
+                      		"with the row kmers and column sample IDs in <output>_kmers.txt and <output>_samples.txt; "
                       		"'table' is a able of overall count per kmer; "
-                      		"'count' gives the total number of kmers (default %default)."))
+                      		"'count' gives the total number of kmers; "
+                      		"'hll' estimates the number of distinct kmers with a HyperLogLog sketch; "
+                      		"'cms' builds a count-min sketch and writes estimated counts of the --query_kmers; "
+                      		"'minhash' builds a MinHash sketch per sample and writes the sample x sample --distance matrix (default %default)."))
     parser.add_option("-v","--verbose",
                       action="store_true",
                       default=False,
@@ -32,101 +56,566 @@ def make_option_parser():
     parser.add_option("-o","--output_file",
                       type="string",
                       default=None,
-                      help="Output filename (required unless --output_type is 'count')",)
+                      help="Output filename (required unless --output_type is 'count', 'hll', 'cms' or 'minhash')",)
+    parser.add_option("-b","--batch_size",
+                      default=1000000,
+                      type='int',
+                      help="Number of bases encoded per batch (default %default)")
+    parser.add_option("-p","--processes",
+                      default=1,
+                      type='int',
+                      help="Number of worker processes; the input is split into record-aligned shards (default %default)")
+    parser.add_option("--temp_dir",
+                      type="string",
+                      default=None,
+                      help="Directory for intermediate files of multi-process and --max_memory runs (default system temp dir)",)
+    parser.add_option("-M","--max_memory",
+                      type="string",
+                      default=None,
+                      help=("Approximate memory budget for kmer counts, e.g. 8gb or 500mb. Counts are spilled to sorted "
+                            "runs in --temp_dir and merged one key range at a time; with --processes the budget is "
+                            "shared by the workers (default no limit)"),)
+    parser.add_option("-e","--sketch_error",
+                      default=0.01,
+                      type='float',
+                      help=("Sketch error bound: relative standard error of the 'hll' estimate, or for 'cms' the "
+                            "maximum overcount as a fraction of all kmers counted (default %default)"))
+    parser.add_option("--sketch_confidence",
+                      default=0.99,
+                      type='float',
+                      help="Probability that 'cms' estimates are within --sketch_error (default %default)")
+    parser.add_option("--save_sketch",
+                      type="string",
+                      default=None,
+                      help="Save the 'hll', 'cms' or 'minhash' sketch to this .npz file so it can be merged with --load_sketches",)
+    parser.add_option("--load_sketches",
+                      type="string",
+                      default=None,
+                      help=("Comma-separated list of saved sketches to merge into this one; they must have been made "
+                            "with the same -k, -t and error settings. --input_fasta is optional with this option"),)
+    parser.add_option("--query_kmers",
+                      type="string",
+                      default=None,
+                      help="File of kmers, one per line, whose estimated counts are written for 'cms'",)
+    parser.add_option("-s","--sketch_size",
+                      default=1000,
+                      type='int',
+                      help="Number of kmer hashes kept per sample for 'minhash' (default %default)")
+    parser.add_option("-d","--distance",
+                      type='string',
+                      default='jaccard',
+                      help=("Distance for 'minhash': jaccard (1 - Jaccard index) or containment "
+                            "(row sample's kmers missing from the column sample) (default %default)"))
     return parser
 
 
+def read_batches(input_fp, batch_size, verbose=False, start=0, end=None):
+    """yields lists of (seq_id, seq) with about batch_size bases in total
+
+    Only the records in the byte range [start, end) are read; start must be
+    the start of a record.
+    """
+    batch = []
+    nbases = 0
+    count = 0
+    for header, seq in read_fasta(input_fp, start, end):
+        count += 1
+        if verbose and count % 100000 == 0:
+            print count
+        # extract only the sequence ID (split on whitespace, first element)
+        batch.append((header.split()[0], seq))
+        nbases += len(seq)
+        if nbases >= batch_size:
+            yield batch
+            batch = []
+            nbases = 0
+    if len(batch) > 0:
+        yield batch
+
+
+def count_kmers(input_fp, ks, output_type, batch_size=1000000, start=0, end=None,
+                output_files=None, verbose=False, max_bytes=None, spill=None, kmers=None):
+    """Counts the kmers of each size in ks in the records in [start, end) of input_fp.
+
+    Each batch of sequences is read and encoded once and then split into
+    kmers of every size. Returns one KmerCounter ('table', 'count') or
+    SampleKmerCounter ('sample_table', 'sparse_table') per kmer size, or adds
+    to and returns the given list of counters or sketches; 'text' and 'fasta'
+    kmers are written to output_files (one per size) as they are read. If
+    max_bytes is given, spill(i, kmers[i]) is called whenever a counter holds
+    more than max_bytes.
+    """
+    # kmers are kept as packed 2-bit keys and only decoded to strings on output
+    if kmers is None:
+        if output_type == 'sample_table' or output_type == 'sparse_table':
+            kmers = [SampleKmerCounter(k) for k in ks]
+        else:
+            kmers = [KmerCounter(k, track_counts=(output_type == 'table')) for k in ks]
+
+    for batch in read_batches(input_fp, batch_size, verbose, start, end):
+        seq_ids = [seq_id for seq_id, seq in batch]
+        codes, offsets = encode_seqs([seq for seq_id, seq in batch])
+        for i, k in enumerate(ks):
+            keys, seq_index, positions = batch_kmers(codes, offsets, k)
+
+            if output_type == 'text' or output_type == 'fasta':
+                # print the kmers in input order (and their sequence IDs if fasta output)
+                kmer_strs = decode_kmers(keys, k)
+                if output_type == 'fasta':
+                    kmer_strs = ['>%s_%09d\n%s' %(seq_ids[j],pos,kmer)
+                                 for kmer, j, pos in zip(kmer_strs, seq_index.tolist(), positions.tolist())]
+                if len(kmer_strs) > 0:
+                    output_files[i].write('\n'.join(kmer_strs) + '\n')
+            elif output_type == 'sample_table' or output_type == 'sparse_table' or output_type == 'minhash':
+                # sample ID is the part of the sequence ID before the first '_'
+                seq_samples = np.array([kmers[i].sample_index(seq_id.split('_')[0])
+                                        for seq_id in seq_ids], dtype=np.uint32)
+                kmers[i].add_samples(keys, seq_samples[seq_index])
+            else:
+                kmers[i].add(keys)
+            if max_bytes is not None and kmers[i].nbytes() > max_bytes:
+                spill(i, kmers[i])
+    return kmers
+
+
+def count_shard(args):
+    """Pool worker: counts one shard of the input into sorted runs on disk.
+
+    Without a memory budget the shard is a single run per kmer size; with
+    one, a size's counts are spilled to a new run each time they fill its
+    share of the budget. Returns (runs, sample IDs), each a list with one
+    entry per kmer size, where a size's runs are (run file prefix, number of
+    keys, prefix histogram). For 'text' and 'fasta' returns the paths of the
+    shard's outputs.
+    """
+    input_fp, start, end, ks, output_type, batch_size, shard_fp, max_memory = args
+    if output_type == 'text' or output_type == 'fasta':
+        shard_fps = ['%s_k%d' %(shard_fp, k) for k in ks]
+        shard_files = [open(fp,'w') for fp in shard_fps]
+        count_kmers(input_fp, ks, output_type, batch_size, start, end, shard_files)
+        for shard_file in shard_files:
+            shard_file.close()
+        return shard_fps
+
+    runs = [[] for k in ks]
+    def spill(i, kmers):
+        keys, counts = kmers.result()
+        run_fp = '%s_k%d_run%04d' %(shard_fp, ks[i], len(runs[i]))
+        np.save(run_fp + '_keys.npy', keys)
+        if counts is not None:
+            np.save(run_fp + '_counts.npy', counts)
+        runs[i].append((run_fp, len(keys), prefix_histogram(keys, ks[i])))
+        kmers.clear()
+
+    # sorting a full counter needs about 4 times its size
+    max_bytes = None
+    if max_memory is not None:
+        max_bytes = max_memory // 4 // len(ks)
+    kmers = count_kmers(input_fp, ks, output_type, batch_size, start, end,
+                        max_bytes=max_bytes, spill=spill)
+    for i in xrange(len(ks)):
+        spill(i, kmers[i])
+    return runs, [getattr(counter, 'sample_ids', None) for counter in kmers]
+
+
+def sketch_shard(args):
+    """Pool worker: adds the kmers of one shard to empty sketches and returns them"""
+    input_fp, start, end, ks, output_type, batch_size, sketches = args
+    return count_kmers(input_fp, ks, output_type, batch_size, start, end, kmers=sketches)
+
+
+def build_sketches(options, ks):
+    """Builds the 'hll', 'cms' or 'minhash' sketch of each kmer size from the
+    input and any --load_sketches"""
+    sketches = []
+    for k in ks:
+        if options.output_type == 'hll':
+            sketches.append(HyperLogLog.from_error(k, options.sketch_error))
+        elif options.output_type == 'minhash':
+            sketches.append(SampleMinHash(k, options.sketch_size))
+        else:
+            sketches.append(CountMinSketch.from_error(k, options.sketch_error, options.sketch_confidence))
+    if options.input_fasta is not None:
+        ranges = record_aligned_ranges(options.input_fasta, options.processes)
+        jobs = [(options.input_fasta, start, end, ks, options.output_type, options.batch_size, sketches)
+                for start, end in ranges]
+        if options.processes > 1:
+            # each shard fills its own copy of the empty sketches
+            pool = multiprocessing.Pool(options.processes)
+            shard_sketches = pool.map(sketch_shard, jobs)
+            pool.close()
+            pool.join()
+            for shard in shard_sketches:
+                for sketch, shard_sketch in zip(sketches, shard):
+                    sketch.merge(shard_sketch)
+        else:
+            count_kmers(options.input_fasta, ks, options.output_type, options.batch_size,
+                        verbose=options.verbose, kmers=sketches)
+    if options.load_sketches is not None:
+        for sketch_fp in options.load_sketches.split(','):
+            loaded = load_sketch(sketch_fp)
+            if loaded.k not in ks:
+                raise ValueError('Sketch %s has k=%d, which is not one of the requested kmer sizes' %(sketch_fp, loaded.k))
+            sketches[ks.index(loaded.k)].merge(loaded)
+    return sketches
+
+
+def write_distance_matrix(output_file, sample_ids, distances):
+    """writes a QIIME-style tab-delimited distance matrix"""
+    output_file.write('\t' + '\t'.join(sample_ids) + '\n')
+    for sample_id, row in zip(sample_ids, distances.tolist()):
+        output_file.write(sample_id + '\t' + '\t'.join(['%.6f' %(x) for x in row]) + '\n')
+
+
+def read_query_kmers(query_fp, k):
+    """(kmer strings, packed keys, mask of the kmers that are valid length-k ACGT)"""
+    queries = []
+    for line in open(query_fp,'U'):
+        words = line.strip().split('\t')
+        if len(words[0]) > 0 and not words[0].startswith('#'):
+            queries.append(words[0])
+    valid = np.array([len(query) == k for query in queries], dtype=bool)
+    codes, offsets = encode_seqs([query for query in queries if len(query) == k])
+    keys, seq_index, positions = batch_kmers(codes, offsets, k)
+    # length-k kmers with non-ACGT characters have no key
+    has_key = np.zeros(int(valid.sum()), dtype=bool)
+    has_key[seq_index] = True
+    valid[np.flatnonzero(valid)[~has_key]] = False
+    return queries, keys, valid
+
+
+def merge_partition(args):
+    """Pool worker: merges one prefix range of every run.
+
+    The ranges are disjoint and in key order, so the partitions' outputs are
+    concatenated as they are. Writes the partition's part of the output and
+    returns its number of distinct kmers.
+    """
+    runs, sample_ids, sample_maps, boundaries, index, k, output_type, part_fp = args
+    keys_list = []
+    counts_list = []
+    for run_fp, sample_map in zip(runs, sample_maps):
+        keys = np.load(run_fp + '_keys.npy', mmap_mode='r')
+        lo, hi = split_by_prefix(keys, k, boundaries)[index:index + 2]
+        keys = np.array(keys[lo:hi])
+        if sample_map is not None:
+            # shard-local sample indices to sorted global ones
+            keys['sample'] = sample_map[keys['sample']]
+        keys_list.append(keys)
+        if output_type != 'count':
+            counts_list.append(np.load(run_fp + '_counts.npy', mmap_mode='r')[lo:hi])
+    keys = np.concatenate(keys_list)
+    if output_type == 'count':
+        return len(np.unique(keys))
+    keys, counts = unique_counts(keys, np.concatenate(counts_list))
+    if output_type == 'table':
+        part_file = open(part_fp,'w')
+        write_kmer_counts(part_file, keys, counts, k)
+        part_file.close()
+    elif output_type == 'sample_table':
+        kmer_keys, indptr, indices, counts = pairs_to_csr(keys, counts, k)
+        part_file = open(part_fp,'w')
+        write_sample_table(part_file, sample_ids, kmer_keys, indptr, indices, counts, k, header=False)
+        part_file.close()
+    elif output_type == 'sparse_table':
+        kmer_keys, indptr, indices, counts = pairs_to_csr(keys, counts, k)
+        np.savez(part_fp, kmer_keys=kmer_keys, indptr=indptr, indices=indices, counts=counts)
+        return len(kmer_keys)
+    return len(keys)
+
+
+def count_kmers_external(options, ks, output_files, output_fps):
+    """Counts kmers in sorted runs on disk, then merges them range by range.
+
+    Used with --processes > 1 or --max_memory. Shards of the input are counted
+    in parallel (spilling to runs when they reach their share of the memory
+    budget), then for each kmer size the key space is cut into contiguous
+    prefix ranges, enough of them that each range fits the budget, and the
+    ranges are merged across all runs. Output is identical to the serial
+    in-memory run. Returns the kmer count of each size for 'count' output.
+    """
+    output_type = options.output_type
+    max_memory = None
+    if options.max_memory is not None:
+        max_memory = parse_memory(options.max_memory) // options.processes
+    ranges = record_aligned_ranges(options.input_fasta, options.processes)
+    temp_dir = tempfile.mkdtemp(prefix='kmers_', dir=options.temp_dir)
+    pool = None
+    if options.processes > 1:
+        pool = multiprocessing.Pool(options.processes)
+    try:
+        jobs = [(options.input_fasta, start, end, ks, output_type, options.batch_size,
+                 os.path.join(temp_dir, 'shard%04d' %(i)), max_memory)
+                for i, (start, end) in enumerate(ranges)]
+        if pool is not None:
+            shard_results = pool.map(count_shard, jobs)
+        else:
+            shard_results = [count_shard(job) for job in jobs]
+        if output_type == 'text' or output_type == 'fasta':
+            for shard_fps in shard_results:
+                for shard_fp, output_file in zip(shard_fps, output_files):
+                    shutil.copyfileobj(open(shard_fp,'r'), output_file)
+            return [None] * len(ks)
+
+        nkmers = []
+        for i, k in enumerate(ks):
+            shards = [(runs[i], sample_ids[i]) for runs, sample_ids in shard_results]
+            nkmers.append(merge_runs(shards, k, output_type, max_memory, options.processes, pool,
+                                     temp_dir, output_files[i], output_fps[i]))
+        return nkmers
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        shutil.rmtree(temp_dir)
+
+
+def merge_runs(shards, k, output_type, max_memory, nworkers, pool, temp_dir, output_file, output_fp):
+    """Merges the runs of one kmer size and writes its output.
+
+    shards is a list of (runs, sample IDs) as returned by count_shard for
+    this size. Returns the number of distinct kmers.
+    """
+    sample_ids = None
+    if output_type == 'sample_table' or output_type == 'sparse_table':
+        sample_ids = sorted(set([sample_id for runs, shard_sample_ids in shards
+                                 for sample_id in shard_sample_ids]))
+        sample_index = dict([(sample_id, i) for i, sample_id in enumerate(sample_ids)])
+    runs = []
+    sample_maps = []
+    histogram = 0
+    nkeys = 0
+    for shard_runs, shard_sample_ids in shards:
+        sample_map = None
+        if sample_ids is not None:
+            sample_map = np.array([sample_index[sample_id] for sample_id in shard_sample_ids], dtype=np.uint32)
+        for run_fp, run_nkeys, run_histogram in shard_runs:
+            runs.append(run_fp)
+            sample_maps.append(sample_map)
+            histogram = histogram + run_histogram
+            nkeys += run_nkeys
+
+    # enough ranges to keep every worker busy and each merge inside the budget
+    nranges = nworkers
+    if max_memory is not None:
+        key_bytes = np.load(runs[0] + '_keys.npy', mmap_mode='r').itemsize
+        if output_type != 'count':
+            key_bytes += 8
+        nranges = max(nranges, int(np.ceil(4.0 * nkeys * key_bytes / max_memory)))
+    boundaries = prefix_ranges(histogram, nranges)
+    part_fps = [os.path.join(temp_dir, 'k%d_part%04d' %(k, i)) for i in xrange(nranges)]
+    jobs = [(runs, sample_ids, sample_maps, boundaries, i, k, output_type, part_fps[i])
+            for i in xrange(nranges)]
+    # parts come back in order; each is appended to the output and removed
+    if pool is not None:
+        parts = pool.imap(merge_partition, jobs)
+    else:
+        parts = (merge_partition(job) for job in jobs)
+
+    if output_type == 'sample_table':
+        output_file.write('#kmer\t' + '\t'.join(sample_ids) + '\n')
+    elif output_type == 'sparse_table':
+        sparse_writer = SparseTableWriter(output_fp, sample_ids, k, temp_dir)
+    nkmers = 0
+    for part_fp, part_nkmers in zip(part_fps, parts):
+        nkmers += part_nkmers
+        if output_type == 'table' or output_type == 'sample_table':
+            shutil.copyfileobj(open(part_fp,'r'), output_file)
+            os.remove(part_fp)
+        elif output_type == 'sparse_table':
+            part = np.load(part_fp + '.npz')
+            sparse_writer.write(part['kmer_keys'], part['indptr'], part['indices'], part['counts'])
+            part.close()
+            os.remove(part_fp + '.npz')
+    if output_type == 'sparse_table':
+        sparse_writer.close()
+    return nkmers
+
+
+def kmer_output_paths(output_fp, ks):
+    """one output path per kmer size: output_fp itself for a single size,
+    otherwise with _k<size> inserted before the extension (and before any
+    .gz/.bz2/.zst)"""
+    if output_fp is None:
+        return [None] * len(ks)
+    if len(ks) == 1:
+        return [output_fp]
+    plain_fp = strip_compression_ext(output_fp)
+    base_fp, ext = os.path.splitext(plain_fp)
+    ext += output_fp[len(plain_fp):]
+    return ['%s_k%d%s' %(base_fp, k, ext) for k in ks]
+
+
+def write_kmer_counts(output_file, keys, counts, k, chunk_size=100000):
+    """writes kmer<tab>count lines, decoding keys one chunk at a time"""
+    for i in xrange(0, len(keys), chunk_size):
+        kmers = decode_kmers(keys[i:i + chunk_size], k)
+        kmer_counts = counts[i:i + chunk_size].tolist()
+        output_file.write(''.join(['%s\t%d\n' %(kmer, kmer_count) for kmer, kmer_count in zip(kmers, kmer_counts)]))
+
+
+def write_sample_table(output_file, sample_ids, kmer_keys, indptr, indices, counts, k, chunk_size=100000, header=True):
+    """writes the dense kmer x sample TSV from CSR counts, one chunk of rows at a time"""
+    if header:
+        output_file.write('#kmer\t' + '\t'.join(sample_ids) + '\n')
+    for start in xrange(0, len(kmer_keys), chunk_size):
+        end = min(start + chunk_size, len(kmer_keys))
+        lo, hi = indptr[start], indptr[end]
+        table = np.zeros((end - start, len(sample_ids)), dtype=np.int64)
+        rows = np.repeat(np.arange(end - start), np.diff(indptr[start:end + 1]))
+        table[rows, indices[lo:hi]] = counts[lo:hi]
+        lines = [kmer + '\t' + '\t'.join([str(x) for x in row])
+                 for kmer, row in zip(decode_kmers(kmer_keys[start:end], k), table.tolist())]
+        output_file.write('\n'.join(lines) + '\n')
+
+
+class SparseTableWriter(object):
+    """Writes kmer x sample counts as a CSR .npz readable by scipy.sparse.load_npz.
+
+    Blocks of rows are added with write() and kept in raw temporary files
+    until close() packs them into the .npz, so only one block is in memory
+    at a time. Row kmers go to <output>_kmers.txt and column sample IDs to
+    <output>_samples.txt, one per line.
+    """
+    def __init__(self, output_fp, sample_ids, k, temp_dir=None):
+        # like numpy.savez, add the .npz extension if it is missing
+        if not output_fp.endswith('.npz'):
+            output_fp += '.npz'
+        self.output_fp = output_fp
+        self.sample_ids = sample_ids
+        self.k = k
+        base_fp = os.path.splitext(output_fp)[0]
+        samples_file = open(base_fp + '_samples.txt','w')
+        for sample_id in sample_ids:
+            samples_file.write(sample_id + '\n')
+        samples_file.close()
+        self.kmers_file = open(base_fp + '_kmers.txt','w')
+
+        self.temp_dir = tempfile.mkdtemp(prefix='sparse_', dir=temp_dir)
+        self.raw_files = {}
+        for name in ['indptr', 'indices', 'data']:
+            self.raw_files[name] = open(os.path.join(self.temp_dir, name + '.raw'),'wb')
+        np.zeros(1, dtype=np.int64).tofile(self.raw_files['indptr'])
+        self.nrows = 0
+        self.nnz = 0
+        self.max_count = 0
+
+    def write(self, kmer_keys, indptr, indices, counts, chunk_size=100000):
+        for start in xrange(0, len(kmer_keys), chunk_size):
+            kmers = decode_kmers(kmer_keys[start:start + chunk_size], self.k)
+            self.kmers_file.write('\n'.join(kmers) + '\n')
+        (indptr[1:] - indptr[0] + self.nnz).astype(np.int64).tofile(self.raw_files['indptr'])
+        np.asarray(indices, dtype=np.int64).tofile(self.raw_files['indices'])
+        np.asarray(counts, dtype=np.int64).tofile(self.raw_files['data'])
+        self.nrows += len(kmer_keys)
+        self.nnz += len(indices)
+        if len(counts) > 0:
+            self.max_count = max(self.max_count, int(counts.max()))
+
+    def close(self, chunk_size=1000000):
+        self.kmers_file.close()
+        dtypes = {'indptr':np.int64,
+                  'indices':np.min_scalar_type(max(len(self.sample_ids) - 1, 0)),
+                  'data':np.min_scalar_type(self.max_count)}
+        output_zip = zipfile.ZipFile(self.output_fp, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+        small_arrays = [('format', np.array(b'csr')),
+                        ('shape', np.array([self.nrows, len(self.sample_ids)]))]
+        for name, array in small_arrays:
+            npy_fp = os.path.join(self.temp_dir, name + '.npy')
+            np.save(npy_fp, array)
+            output_zip.write(npy_fp, name + '.npy')
+        for name in ['data', 'indices', 'indptr']:
+            # copy the raw int64 values into an .npy of the final dtype, a chunk at a time
+            self.raw_files[name].close()
+            raw_fp = os.path.join(self.temp_dir, name + '.raw')
+            npy_fp = os.path.join(self.temp_dir, name + '.npy')
+            nvalues = os.path.getsize(raw_fp) // 8
+            npy = np.lib.format.open_memmap(npy_fp, mode='w+', dtype=dtypes[name], shape=(nvalues,))
+            if nvalues > 0:
+                raw = np.memmap(raw_fp, dtype=np.int64, mode='r')
+                for start in xrange(0, nvalues, chunk_size):
+                    npy[start:start + chunk_size] = raw[start:start + chunk_size]
+                del raw
+            npy.flush()
+            del npy
+            output_zip.write(npy_fp, name + '.npy')
+        output_zip.close()
+        shutil.rmtree(self.temp_dir)
+
+
 if __name__ == '__main__':
 	# make option parser and parse command line flags
     parser = make_option_parser()
     (options, args) = parser.parse_args()
+    if options.output_type == 'cms' and options.query_kmers is None and options.save_sketch is None:
+        parser.error("-t cms requires --query_kmers or --save_sketch")
     
-    k = options.kmer_size
+    ks = [int(k) for k in options.kmer_size.split(',')]
     input_fp = options.input_fasta
     
-    # create and open output file if needed
-    if options.output_file is not None:
-        output_file = open(options.output_file,'w')
-
+    # create and open output files if needed, one per kmer size
+    # (the sparse table is written with numpy once counting is done)
+    output_fps = kmer_output_paths(options.output_file, ks)
+    output_files = [None] * len(ks)
+    if options.output_file is not None and options.output_type != 'sparse_table':
+        output_files = [open_output(output_fp) for output_fp in output_fps]
 
-    kmers = set() # set to hold unique kmers, faster than dict or ordered list
-    kmer_counts = dict() # only used if --output_type == 'table'
-    sample_kmer_counts = dict() # only used if --output_type == 'sample_table'
+    nkmers = [None] * len(ks)
+    if options.output_type in ['hll', 'cms', 'minhash']:
+        sketches = build_sketches(options, ks)
+        for i, (k, sketch) in enumerate(zip(ks, sketches)):
+            if options.save_sketch is not None:
+                sketch.save(kmer_output_paths(options.save_sketch, ks)[i])
+            output_file = output_files[i]
+            if output_file is None:
+                output_file = sys.stdout
+                if len(ks) > 1 and options.output_type != 'hll':
+                    print '#k=%d' %(k)
+            if options.output_type == 'hll':
+                nkmers[i] = sketch.estimate()
+            elif options.output_type == 'minhash':
+                sample_ids, distances = sketch.distances(options.distance)
+                write_distance_matrix(output_file, sample_ids, distances)
+            elif options.query_kmers is not None:
+                queries, keys, valid = read_query_kmers(options.query_kmers, k)
+                estimates = np.zeros(len(queries), dtype=np.int64)
+                estimates[valid] = sketch.query(keys)
+                output_file.write(''.join(['%s\t%d\n' %(query, estimate)
+                                           for query, estimate in zip(queries, estimates.tolist())]))
+    elif options.processes > 1 or options.max_memory is not None:
+        nkmers = count_kmers_external(options, ks, output_files, output_fps)
+    else:
+        kmers = count_kmers(input_fp, ks, options.output_type, options.batch_size,
+                            output_files=output_files, verbose=options.verbose)
+        for i, k in enumerate(ks):
+            if options.output_type == 'count':
+                nkmers[i] = len(kmers[i])
+            elif options.output_type == 'table':
+                keys, counts = kmers[i].result()
+                write_kmer_counts(output_files[i], keys, counts, k)
+            elif options.output_type == 'sample_table':
+                write_sample_table(output_files[i], *kmers[i].sparse_result(), k=k)
+            elif options.output_type == 'sparse_table':
+                sample_ids, kmer_keys, indptr, indices, counts = kmers[i].sparse_result()
+                sparse_writer = SparseTableWriter(output_fps[i], sample_ids, k, options.temp_dir)
+                sparse_writer.write(kmer_keys, indptr, indices, counts)
+                sparse_writer.close()
+            # free this size's counts before writing the next
+            kmers[i] = None
 
-    # print new kmers as we read them
-    # this will reduce memory requirements because
-    # we don't have to store the sequence IDs
-    count = 0
-    for line in open(input_fp,'U'):
-
-        if line.startswith('>'):
-        	# if this is a sequence header
-            count += 1
-            if options.verbose and count % 100000 == 0:
-                print count
-                
-            # extract only the sequence ID (split on whitespace, first element)
-            seq_id = line[1:].split()[0]
-            sample_id = seq_id.split('_')[0]
-        else:
-        	# remove trailing whitespace characters
-            seq = line.strip()
-            
-            if len(seq) < k:
-                continue
-            
-            # if this sequence is long enough to have a k-mer
-
-            # step through sequence on base at a time
-            for i in xrange(0,len(seq)-k + 1):
-                # current kmer is a substring of length k
-                kmer = seq[i:i+k]
-
-                # add to set of kmers
-                kmers.add(kmer)
-
-                if options.output_type == 'text' or options.output_type == 'fasta':
-                    # print the kmer (and its sequence ID if fasta output)
-                    if options.output_type == 'fasta':
-                        kmer_id = '>%s_%09d' %(seq_id,i)
-                        output_file.write(kmer_id + '\n')
-                    output_file.write(kmer + '\n')
-                elif options.output_type == 'sample_table':
-                    if not sample_kmer_counts.has_key(sample_id):
-                        sample_kmer_counts[sample_id] = dict()
-                    if not sample_kmer_counts[sample_id].has_key(kmer):
-                        sample_kmer_counts[sample_id][kmer] = 0
-                    sample_kmer_counts[sample_id][kmer] += 1
-                elif options.output_type == 'table':
-                    if kmer not in  kmer_counts:
-                        kmer_counts[kmer] = 0
-                    kmer_counts[kmer] += 1
-
-    if options.output_type == 'count':
+    if options.output_type == 'count' or options.output_type == 'hll':
 	    # print count if requested
-        if options.output_file is not None:
-            output_file.write(str(len(kmers)) + '\n')
-        else:
-            print len(kmers)
-    elif options.output_type == 'table':
-        kmers = sorted(kmers)
-        for kmer in kmers:
-            output_file.write(kmer + '\t' + str(kmer_counts[kmer]) + '\n')
-    elif options.output_type == 'sample_table':
-        sample_ids = sorted(sample_kmer_counts.keys())
-        kmers = sorted(kmers)
-        output_file.write('#kmer\t' + '\t'.join(sample_ids) + '\n')
-        for kmer in kmers:
-            output_file.write(kmer)
-            for sample_id in sample_ids:
-                if sample_kmer_counts[sample_id].has_key(kmer):
-                    output_file.write('\t' + str(sample_kmer_counts[sample_id][kmer]))
-                else:
-                    output_file.write('\t0')
-            output_file.write('\n')
+        for i, k in enumerate(ks):
+            if output_files[i] is not None:
+                output_files[i].write(str(nkmers[i]) + '\n')
+            elif len(ks) > 1:
+                print '%d\t%d' %(k, nkmers[i])
+            else:
+                print nkmers[i]
     
-    if options.output_file is not None:
-        output_file.close()
+    for output_file in output_files:
+        if output_file is not None:
+            output_file.close()
 
         
 
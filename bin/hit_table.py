@@ -0,0 +1,144 @@
+# columnar binary tables of usearch blast6 hits
+#
+# a hit table is a directory with one raw little-endian file per blast6
+# column, the query and target labels dictionary-encoded as int32 codes
+# into query_ids.txt and target_ids.txt (one label per line, in code order),
+# and schema.json giving each column's dtype and the number of hits.
+# Numeric columns are stored as numbers, so readers memory-map only the
+# columns they need instead of re-splitting every line of a text file:
+#
+#   table = HitTable('hits.cols')
+#   identity = table.column('identity')     # numpy memmap
+#   queries = table.labels('query')[table.column('query')]
+#
+# HitTableWriter is file-like: blast6 text written to it, in any pieces, is
+# parsed a block of lines at a time and appended to the column files.
+
+import os
+import json
+import numpy as np
+
+# blast6 columns in file order with their stored dtypes; query and target
+# hold label codes
+BLAST6_COLUMNS = [('query', '<i4'),
+                  ('target', '<i4'),
+                  ('identity', '<f4'),
+                  ('alignment_length', '<i4'),
+                  ('mismatches', '<i4'),
+                  ('gap_opens', '<i4'),
+                  ('query_start', '<i4'),
+                  ('query_end', '<i4'),
+                  ('target_start', '<i4'),
+                  ('target_end', '<i4'),
+                  ('evalue', '<f8'),
+                  ('bitscore', '<f4')]
+LABEL_COLUMNS = ['query', 'target']
+SCHEMA_FILE = 'schema.json'
+WRITE_BLOCK_SIZE = 4 * 2 ** 20
+
+
+def is_hit_table(fp):
+    """whether fp is a hit table directory"""
+    return os.path.isdir(fp) and os.path.exists(os.path.join(fp, SCHEMA_FILE))
+
+
+class HitTableWriter(object):
+    """Writes blast6 text as a hit table in output_dir.
+
+    Labels get codes in order of first appearance. The schema is written by
+    close(), so a table without one was not finished.
+    """
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        schema_fp = os.path.join(output_dir, SCHEMA_FILE)
+        if os.path.exists(schema_fp):
+            os.remove(schema_fp)
+        self.column_files = [open(os.path.join(output_dir, name + '.bin'), 'wb')
+                             for name, dtype in BLAST6_COLUMNS]
+        self.label_files = dict([(name, open(os.path.join(output_dir, name + '_ids.txt'), 'wb'))
+                                 for name in LABEL_COLUMNS])
+        self.codes = dict([(name, {}) for name in LABEL_COLUMNS])
+        self.nrows = 0
+        self.pending = []
+        self.pending_size = 0
+
+    def _code(self, name, label):
+        codes = self.codes[name]
+        code = codes.get(label)
+        if code is None:
+            code = codes[label] = len(codes)
+            self.label_files[name].write(label + b'\n')
+        return code
+
+    def _write_lines(self, lines):
+        rows = [line.rstrip(b'\r').split(b'\t') for line in lines if len(line) > 0]
+        if len(rows) == 0:
+            return
+        for row in rows:
+            if len(row) != len(BLAST6_COLUMNS):
+                raise ValueError('Expected %d blast6 columns, got %d: %r' %(len(BLAST6_COLUMNS), len(row), b'\t'.join(row)))
+        columns = list(zip(*rows))
+        for i, (name, dtype) in enumerate(BLAST6_COLUMNS):
+            if name in LABEL_COLUMNS:
+                values = np.array([self._code(name, label) for label in columns[i]], dtype=dtype)
+            else:
+                values = np.array(columns[i]).astype(np.float64).astype(dtype)
+            self.column_files[i].write(values.tostring())
+        self.nrows += len(rows)
+
+    def write(self, text):
+        """adds blast6 text; a last incomplete line waits for the next write"""
+        self.pending.append(text)
+        self.pending_size += len(text)
+        if self.pending_size >= WRITE_BLOCK_SIZE:
+            self.flush()
+
+    def flush(self):
+        """writes the complete lines written so far"""
+        text = b''.join(self.pending)
+        cut = text.rfind(b'\n') + 1
+        self._write_lines(text[:cut].split(b'\n'))
+        self.pending = [text[cut:]]
+        self.pending_size = len(text) - cut
+
+    def close(self):
+        self.pending.append(b'\n')
+        self.flush()
+        for output_file in self.column_files + list(self.label_files.values()):
+            output_file.close()
+        schema = {'nrows': self.nrows,
+                  'columns': [[name, dtype] for name, dtype in BLAST6_COLUMNS]}
+        schema_file = open(os.path.join(self.output_dir, SCHEMA_FILE), 'w')
+        json.dump(schema, schema_file, indent=2, separators=(',', ': '))
+        schema_file.write('\n')
+        schema_file.close()
+
+
+class HitTable(object):
+    """Read-only access to a hit table written by HitTableWriter"""
+    def __init__(self, input_dir):
+        self.input_dir = input_dir
+        schema = json.load(open(os.path.join(input_dir, SCHEMA_FILE)))
+        self.nrows = schema['nrows']
+        self.dtypes = dict([(name, np.dtype(str(dtype))) for name, dtype in schema['columns']])
+        self._labels = {}
+
+    def __len__(self):
+        return self.nrows
+
+    def column(self, name):
+        """memory-mapped array of one column"""
+        if self.nrows == 0:
+            return np.zeros(0, dtype=self.dtypes[name])
+        return np.memmap(os.path.join(self.input_dir, name + '.bin'), dtype=self.dtypes[name],
+                         mode='r', shape=(self.nrows,))
+
+    def labels(self, name):
+        """array of the 'query' or 'target' labels, indexed by code"""
+        if name not in self._labels:
+            label_file = open(os.path.join(self.input_dir, name + '_ids.txt'), 'rb')
+            self._labels[name] = np.array(label_file.read().split(b'\n')[:-1], dtype=object)
+            label_file.close()
+        return self._labels[name]
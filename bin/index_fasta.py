@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+# writes a samtools-style .fai index next to a fasta file
+# (ID, length, byte offset, bases per line, bytes per line)
+# filter_img_fasta_by_taxon_id.py uses the index when it is present and
+# up to date
+# usage:
+# index_fasta.py -i input.fasta [-o input.fasta.fai]
+
+from optparse import OptionParser
+from fasta_utils import build_fasta_index
+
+def make_option_parser():
+    parser = OptionParser(usage="usage: %prog [options] filename",
+                          version="%prog 1.0")
+    parser.add_option("-i", "--input_fasta",
+                      default=None,
+                      type='string',
+                      help="input fasta (required)")
+    parser.add_option("-o","--output_fp",
+                      type="string",
+                      default=None,
+                      help="Output index filename (default <input_fasta>.fai)",)
+    return parser
+
+if __name__ == '__main__':
+    parser = make_option_parser()
+    (options, args) = parser.parse_args()
+    if options.input_fasta is None:
+        raise ValueError('Please supply --input_fasta')
+    build_fasta_index(options.input_fasta, options.output_fp)
@@ -0,0 +1,297 @@
+# fixed-memory sketches of packed k-mers (see kmer_utils.py)
+#
+# HyperLogLog estimates the number of distinct k-mers, CountMinSketch
+# estimates the count of any k-mer and SampleMinHash keeps a MinHash sketch
+# per sample for sample-to-sample distances. Each uses a fixed amount of
+# memory (per sample for SampleMinHash) however much sequence is added, and
+# sketches built with the same settings (k, size, seed) from different files
+# can be merged and saved with save()/load_sketch().
+
+import numpy as np
+from kmer_utils import hash_kmers
+
+
+def _bit_length(x):
+    """number of significant bits of each value of a uint64 array"""
+    x = x.copy()
+    lengths = np.zeros(len(x), dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        high = x >= np.uint64(1 << shift)
+        lengths[high] += shift
+        x[high] >>= np.uint64(shift)
+    lengths += (x > 0)
+    return lengths
+
+
+class HyperLogLog(object):
+    """Estimates the number of distinct k-mers with 2**p one-byte registers.
+
+    The relative standard error of the estimate is about 1.04 / sqrt(2**p).
+    """
+    def __init__(self, k, p=14, seed=0):
+        if p < 4 or p > 30:
+            raise ValueError('HyperLogLog precision must be between 4 and 30, got %d' % p)
+        self.k = k
+        self.p = p
+        self.seed = seed
+        self.registers = np.zeros(2 ** p, dtype=np.uint8)
+
+    @classmethod
+    def from_error(cls, k, error, seed=0):
+        """smallest sketch with relative standard error at most error"""
+        p = int(np.ceil(2 * np.log2(1.04 / error)))
+        return cls(k, max(p, 4), seed)
+
+    def add(self, keys, counts=None):
+        """adds packed k-mer keys; counts are ignored"""
+        if len(keys) == 0:
+            return
+        hashes = hash_kmers(keys, self.seed)
+        index = (hashes >> np.uint64(64 - self.p)).astype(np.int64)
+        # rank = position of the first 1 bit in the remaining 64 - p bits
+        rest = hashes & np.uint64((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - _bit_length(rest) + 1
+        # keep the largest rank per register
+        combined = np.unique((index << 8) | rank)
+        index = combined >> 8
+        last = np.ones(len(combined), dtype=bool)
+        last[:-1] = index[1:] != index[:-1]
+        index = index[last]
+        self.registers[index] = np.maximum(self.registers[index], (combined[last] & 255).astype(np.uint8))
+
+    def merge(self, other):
+        """adds everything seen by another HyperLogLog with the same settings"""
+        if (other.k, other.p, other.seed) != (self.k, self.p, self.seed):
+            raise ValueError('Cannot merge HyperLogLog sketches with different k, precision or seed')
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def estimate(self):
+        """estimated number of distinct k-mers added"""
+        m = float(len(self.registers))
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(2.0 ** -self.registers.astype(np.float64))
+        zeros = np.sum(self.registers == 0)
+        if estimate <= 2.5 * m and zeros > 0:
+            # linear counting is more accurate for small cardinalities
+            estimate = m * np.log(m / zeros)
+        return int(round(estimate))
+
+    def save(self, fp):
+        np.savez(fp, sketch=np.array(b'hll'), k=self.k, p=self.p, seed=self.seed,
+                 registers=self.registers)
+
+
+class CountMinSketch(object):
+    """Approximate k-mer counts in a depth x width table of counters.
+
+    Estimates are never below the true count, and with probability
+    1 - exp(-depth) exceed it by at most e / width times the total number
+    of k-mers added.
+    """
+    def __init__(self, k, width, depth, seed=0):
+        self.k = k
+        self.width = width
+        self.depth = depth
+        self.seed = seed
+        self.table = np.zeros((depth, width), dtype=np.int64)
+        self.total = 0
+
+    @classmethod
+    def from_error(cls, k, error, confidence=0.99, seed=0):
+        """Sketch whose estimates exceed the true count by at most error * total
+        k-mers with probability confidence."""
+        width = int(np.ceil(np.e / error))
+        depth = int(np.ceil(np.log(1.0 / (1.0 - confidence))))
+        return cls(k, width, max(depth, 1), seed)
+
+    def _columns(self, keys):
+        """column of each key in each row (double hashing of one 64-bit hash)"""
+        hashes = hash_kmers(keys, self.seed)
+        h1 = hashes & np.uint64(0xffffffff)
+        h2 = (hashes >> np.uint64(32)) | np.uint64(1)
+        for row in range(self.depth):
+            yield row, ((h1 + np.uint64(row) * h2) % np.uint64(self.width)).astype(np.int64)
+
+    def add(self, keys, counts=None):
+        """adds packed k-mer keys, each counted once or counts[i] times"""
+        if len(keys) == 0:
+            return
+        for row, columns in self._columns(keys):
+            self.table[row] += np.bincount(columns, weights=counts, minlength=self.width).astype(np.int64)
+        if counts is None:
+            self.total += len(keys)
+        else:
+            self.total += int(np.sum(counts))
+
+    def query(self, keys):
+        """estimated count of each packed k-mer key"""
+        estimates = np.zeros(len(keys), dtype=np.int64)
+        if len(keys) == 0:
+            return estimates
+        estimates.fill(np.iinfo(np.int64).max)
+        for row, columns in self._columns(keys):
+            np.minimum(estimates, self.table[row, columns], out=estimates)
+        return estimates
+
+    def merge(self, other):
+        """adds everything counted by another CountMinSketch with the same settings"""
+        if (other.k, other.width, other.depth, other.seed) != (self.k, self.width, self.depth, self.seed):
+            raise ValueError('Cannot merge count-min sketches with different k, width, depth or seed')
+        self.table += other.table
+        self.total += other.total
+
+    def save(self, fp):
+        np.savez(fp, sketch=np.array(b'cms'), k=self.k, width=self.width, depth=self.depth,
+                 seed=self.seed, total=self.total, table=self.table)
+
+
+class SampleMinHash(object):
+    """Bottom-s MinHash sketch of the k-mers of each sample.
+
+    Keeps the sketch_size smallest distinct k-mer hashes of every sample, as
+    one array of (sample index, hash) sorted by sample and then hash.
+    """
+    def __init__(self, k, sketch_size=1000, seed=0):
+        self.k = k
+        self.sketch_size = sketch_size
+        self.seed = seed
+        self.sample_ids = []
+        self._sample_index = {}
+        self.samples = np.zeros(0, dtype=np.int64)
+        self.hashes = np.zeros(0, dtype=np.uint64)
+        # hashes below a sample's threshold may enter its sketch
+        self.thresholds = np.zeros(0, dtype=np.uint64)
+
+    def sample_index(self, sample_id):
+        """index of sample_id, added on first use"""
+        if sample_id not in self._sample_index:
+            self._sample_index[sample_id] = len(self.sample_ids)
+            self.sample_ids.append(sample_id)
+            self.thresholds = np.append(self.thresholds, np.uint64(np.iinfo(np.uint64).max))
+        return self._sample_index[sample_id]
+
+    def add_samples(self, keys, samples):
+        """adds packed k-mer keys, with samples[i] the sample index of keys[i]"""
+        if len(keys) == 0:
+            return
+        hashes = hash_kmers(keys, self.seed)
+        samples = np.asarray(samples, dtype=np.int64)
+        keep = hashes < self.thresholds[samples]
+        self._update(samples[keep], hashes[keep])
+
+    def _update(self, samples, hashes):
+        """folds (sample, hash) pairs into the sketches"""
+        samples = np.concatenate((self.samples, samples))
+        hashes = np.concatenate((self.hashes, hashes))
+        order = np.lexsort((hashes, samples))
+        samples = samples[order]
+        hashes = hashes[order]
+        distinct = np.ones(len(samples), dtype=bool)
+        distinct[1:] = (samples[1:] != samples[:-1]) | (hashes[1:] != hashes[:-1])
+        samples = samples[distinct]
+        hashes = hashes[distinct]
+        # position of each hash within its sample's sorted hashes
+        sizes = np.bincount(samples, minlength=len(self.sample_ids))
+        starts = np.cumsum(sizes) - sizes
+        rank = np.arange(len(samples)) - starts[samples]
+        keep = rank < self.sketch_size
+        self.samples = samples[keep]
+        self.hashes = hashes[keep]
+        sizes = np.minimum(sizes, self.sketch_size)
+        ends = np.cumsum(sizes)
+        full = np.flatnonzero(sizes == self.sketch_size)
+        self.thresholds[full] = self.hashes[ends[full] - 1]
+
+    def merge(self, other):
+        """adds the sketches of another SampleMinHash with the same settings"""
+        if (other.k, other.sketch_size, other.seed) != (self.k, self.sketch_size, self.seed):
+            raise ValueError('Cannot merge MinHash sketches with different k, sketch size or seed')
+        index = np.array([self.sample_index(sample_id) for sample_id in other.sample_ids], dtype=np.int64)
+        self._update(index[other.samples], other.hashes)
+
+    def distances(self, metric='jaccard'):
+        """Pairwise distances between the samples' k-mer sets.
+
+        Returns (sorted sample IDs, distance matrix). 'jaccard' is 1 - the
+        Jaccard index; 'containment' is asymmetric, with row a, column b
+        being 1 - the fraction of sample a's k-mers found in sample b. Each
+        pair is compared on the hashes below the smaller of their two
+        sketch maxima.
+        """
+        if metric not in ('jaccard', 'containment'):
+            raise ValueError('Unknown distance metric %s' % metric)
+        sample_ids = sorted(self.sample_ids)
+        order = np.array([self._sample_index[sample_id] for sample_id in sample_ids], dtype=np.int64)
+        n = len(sample_ids)
+        rank = np.zeros(n, dtype=np.int64)
+        rank[order] = np.arange(n)
+        samples = rank[self.samples]
+        resort = np.lexsort((self.hashes, samples))
+        samples = samples[resort]
+        hashes = self.hashes[resort]
+        thresholds = self.thresholds[order]
+        bounds = np.concatenate(([0], np.cumsum(np.bincount(samples, minlength=n))))
+
+        # shared hashes are below both samples' maxima, so the intersection
+        # is the plain overlap of the sketches: a sample x hash product
+        shared, columns, multiplicity = np.unique(hashes, return_inverse=True, return_counts=True)
+        shared_entries = multiplicity[columns] > 1
+        column_map = np.cumsum(multiplicity > 1) - 1
+        entry_samples = samples[shared_entries]
+        entry_columns = column_map[columns[shared_entries]]
+        nshared = int(np.sum(multiplicity > 1))
+        intersection = np.zeros((n, n), dtype=np.float64)
+        chunk_size = max(1, 2 ** 24 // max(n, 1))
+        for start in range(0, nshared, chunk_size):
+            in_chunk = (entry_columns >= start) & (entry_columns < start + chunk_size)
+            incidence = np.zeros((n, min(chunk_size, nshared - start)), dtype=np.float32)
+            incidence[entry_samples[in_chunk], entry_columns[in_chunk] - start] = 1
+            intersection += np.dot(incidence, incidence.T)
+        for a in range(n):
+            intersection[a, a] = bounds[a + 1] - bounds[a]
+
+        # sizes[a, b] = number of sample a's hashes below the pair's threshold
+        sizes = np.zeros((n, n), dtype=np.float64)
+        for a in range(n):
+            pair_thresholds = np.minimum(thresholds[a], thresholds)
+            sizes[a] = np.searchsorted(hashes[bounds[a]:bounds[a + 1]], pair_thresholds, side='right')
+
+        if metric == 'jaccard':
+            denominator = sizes + sizes.T - intersection
+        else:
+            denominator = sizes
+        similarity = np.zeros((n, n), dtype=np.float64)
+        nonzero = denominator > 0
+        similarity[nonzero] = intersection[nonzero] / denominator[nonzero]
+        distances = 1.0 - similarity
+        np.fill_diagonal(distances, 0.0)
+        return sample_ids, distances
+
+    def save(self, fp):
+        np.savez(fp, sketch=np.array(b'minhash'), k=self.k, sketch_size=self.sketch_size,
+                 seed=self.seed, sample_ids=np.array(self.sample_ids, dtype=bytes),
+                 samples=self.samples, hashes=self.hashes)
+
+
+def load_sketch(fp):
+    """loads a HyperLogLog, CountMinSketch or SampleMinHash written by its save()"""
+    data = np.load(fp)
+    sketch_type = data['sketch'].item()
+    if not isinstance(sketch_type, str):
+        sketch_type = sketch_type.decode('ascii')
+    if sketch_type == 'hll':
+        sketch = HyperLogLog(int(data['k']), int(data['p']), int(data['seed']))
+        sketch.registers[:] = data['registers']
+    elif sketch_type == 'cms':
+        sketch = CountMinSketch(int(data['k']), int(data['width']), int(data['depth']), int(data['seed']))
+        sketch.table[:] = data['table']
+        sketch.total = int(data['total'])
+    elif sketch_type == 'minhash':
+        sketch = SampleMinHash(int(data['k']), int(data['sketch_size']), int(data['seed']))
+        sample_ids = data['sample_ids'].astype(str).tolist()
+        index = np.array([sketch.sample_index(sample_id) for sample_id in sample_ids], dtype=np.int64)
+        sketch._update(index[data['samples']], data['hashes'])
+    else:
+        raise ValueError('Unknown sketch type %s in %s' % (sketch_type, fp))
+    data.close()
+    return sketch
@@ -0,0 +1,376 @@
+# packed 2-bit k-mer engine shared by the k-mer scripts
+#
+# bases are coded A=0, C=1, G=2, T=3 (case-insensitive); anything else is
+# treated as a break in the sequence and no k-mer spans it.
+# k-mers with k <= 32 are stored as uint64 keys; longer k-mers use a
+# structured key of ceil(k/32) uint64 words ('w0', 'w1', ...), each word
+# holding up to 32 bases, first base in the high bits. Sorting packed keys
+# gives the same order as sorting the k-mer strings.
+
+import numpy as np
+
+BASES_PER_WORD = 32
+INVALID_CODE = 4
+PREFIX_BITS = 16
+
+BASE_CODES = np.empty(256, dtype=np.uint8)
+BASE_CODES.fill(INVALID_CODE)
+for _code, _base in enumerate('ACGT'):
+    BASE_CODES[ord(_base)] = _code
+    BASE_CODES[ord(_base.lower())] = _code
+
+CODE_BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+
+
+def kmer_dtype(k):
+    """numpy dtype of the packed key for k-mers of length k"""
+    if k < 1:
+        raise ValueError('k-mer size must be positive, got %d' % k)
+    if k <= BASES_PER_WORD:
+        return np.dtype(np.uint64)
+    nwords = (k + BASES_PER_WORD - 1) // BASES_PER_WORD
+    return np.dtype([('w%d' % i, np.uint64) for i in range(nwords)])
+
+
+def sample_kmer_dtype(k):
+    """dtype of a (k-mer, sample index) key; sorts by k-mer, then sample"""
+    dtype = kmer_dtype(k)
+    if dtype.names is None:
+        fields = [('w0', np.uint64)]
+    else:
+        fields = [(name, dtype[name]) for name in dtype.names]
+    return np.dtype(fields + [('sample', np.uint32)])
+
+
+def word_lengths(k):
+    """number of bases held by each word of a packed k-mer"""
+    lengths = [BASES_PER_WORD] * (k // BASES_PER_WORD)
+    if k % BASES_PER_WORD:
+        lengths.append(k % BASES_PER_WORD)
+    return lengths
+
+
+def encode_seqs(seqs):
+    """Codes a list of sequences into one uint8 array.
+
+    Sequences are separated by one invalid code so no k-mer crosses from one
+    sequence into the next. Returns (codes, offsets) where offsets[i] is the
+    index of the first base of seqs[i] in codes.
+    """
+    buf = b'\n'.join([s if isinstance(s, bytes) else s.encode('ascii') for s in seqs])
+    codes = BASE_CODES[np.frombuffer(buf, dtype=np.uint8)]
+    lengths = np.array([len(s) for s in seqs], dtype=np.int64)
+    offsets = np.zeros(len(seqs), dtype=np.int64)
+    if len(seqs) > 1:
+        offsets[1:] = np.cumsum(lengths[:-1] + 1)
+    return codes, offsets
+
+
+def _pack_windows(codes, k):
+    """uint64 key of every length-k window of codes (k <= 32).
+
+    Builds keys for windows of length 1, 2, 4, ... by doubling and combines
+    the ones in the binary expansion of k, so the cost is O(n log k).
+    """
+    n_codes = len(codes)
+    result, result_len = None, 0
+    block, block_len = (codes & 3).astype(np.uint64), 1
+    while k:
+        if k & 1:
+            if result is None:
+                result, result_len = block, block_len
+            else:
+                m = n_codes - result_len - block_len + 1
+                result = (result[:m] << np.uint64(2 * block_len)) | block[result_len:result_len + m]
+                result_len += block_len
+        k >>= 1
+        if k:
+            m = n_codes - 2 * block_len + 1
+            block = (block[:m] << np.uint64(2 * block_len)) | block[block_len:block_len + m]
+            block_len *= 2
+    return result
+
+
+def pack_kmers(codes, k, starts=None):
+    """Packed keys of the length-k windows of codes.
+
+    If starts is given only the windows starting at those indices are returned.
+    """
+    dtype = kmer_dtype(k)
+    n = len(codes) - k + 1
+    if n <= 0:
+        return np.zeros(0, dtype=dtype)
+    if starts is None:
+        starts = slice(0, n)
+    if k <= BASES_PER_WORD:
+        return _pack_windows(codes, k)[starts]
+    words = word_lengths(k)
+    first = _pack_windows(codes, words[0])[:n][starts]
+    keys = np.zeros(len(first), dtype=dtype)
+    keys['w0'] = first
+    for i in range(1, len(words)):
+        offset = i * BASES_PER_WORD
+        keys['w%d' % i] = _pack_windows(codes[offset:], words[i])[:n][starts]
+    return keys
+
+
+def valid_starts(codes, k):
+    """indices of the length-k windows of codes that contain only ACGT"""
+    n = len(codes) - k + 1
+    if n <= 0:
+        return np.zeros(0, dtype=np.int64)
+    invalid = np.zeros(len(codes) + 1, dtype=np.int64)
+    np.cumsum(codes > 3, out=invalid[1:])
+    return np.flatnonzero(invalid[k:] == invalid[:n])
+
+
+def batch_kmers(codes, offsets, k):
+    """All valid k-mers in a batch coded by encode_seqs.
+
+    Returns (keys, seq_index, positions): the packed k-mers in input order,
+    the index of the sequence each came from, and its 0-based position in
+    that sequence.
+    """
+    starts = valid_starts(codes, k)
+    seq_index = np.searchsorted(offsets, starts, side='right') - 1
+    positions = starts - offsets[seq_index]
+    return pack_kmers(codes, k, starts), seq_index, positions
+
+
+def decode_kmers(keys, k):
+    """list of k-mer strings for an array of packed keys"""
+    chars = np.empty((len(keys), k), dtype=np.uint8)
+    if k <= BASES_PER_WORD:
+        words = [keys]
+    else:
+        words = [keys['w%d' % i] for i in range(len(keys.dtype.names))]
+    col = 0
+    for word, length in zip(words, word_lengths(k)):
+        for j in range(length):
+            shift = np.uint64(2 * (length - 1 - j))
+            chars[:, col] = CODE_BASES[(word >> shift) & np.uint64(3)]
+            col += 1
+    return chars.view('S%d' % k).ravel().astype(str).tolist()
+
+
+def _mix64(x):
+    """splitmix64 finalizer on a uint64 array (wraps modulo 2**64)"""
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+def hash_kmers(keys, seed=0):
+    """uint64 hashes of packed keys; different seeds give unrelated hashes"""
+    if keys.dtype.names is None:
+        words = [keys]
+    else:
+        words = [keys[name] for name in keys.dtype.names]
+    hashes = _mix64(np.array([seed], dtype=np.uint64))[0] ^ words[0]
+    hashes = _mix64(hashes)
+    for word in words[1:]:
+        hashes = _mix64(hashes ^ word)
+    return hashes
+
+
+def unique_counts(keys, counts=None):
+    """Sorted unique keys and the summed count of each.
+
+    counts defaults to one per key.
+    """
+    if counts is None:
+        return np.unique(keys, return_counts=True)
+    order = np.argsort(keys)
+    keys = keys[order]
+    if len(keys) == 0:
+        return keys, counts[order]
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = keys[1:] != keys[:-1]
+    starts = np.flatnonzero(first)
+    return keys[starts], np.add.reduceat(counts[order], starts)
+
+
+def leading_word(keys):
+    """first uint64 word of packed keys; sorted keys have sorted leading words"""
+    if keys.dtype.names is None:
+        return keys
+    return keys['w0']
+
+
+def _prefix_layout(k):
+    """(bits, shift) of the leading-base prefix used to partition keys"""
+    word_bits = 2 * min(k, BASES_PER_WORD)
+    bits = min(PREFIX_BITS, word_bits)
+    return bits, word_bits - bits
+
+
+def prefix_histogram(keys, k, counts=None):
+    """number of keys (or summed counts) with each leading-base prefix"""
+    bits, shift = _prefix_layout(k)
+    prefixes = (leading_word(keys) >> np.uint64(shift)).astype(np.int64)
+    return np.bincount(prefixes, weights=counts, minlength=2 ** bits).astype(np.int64)
+
+
+def prefix_ranges(histogram, n):
+    """Splits the prefix space into n contiguous ranges of about equal weight.
+
+    Returns n + 1 increasing prefix boundaries; range i holds the prefixes
+    boundaries[i] <= prefix < boundaries[i+1]. Because the ranges follow key
+    order, concatenating per-range results keeps the keys sorted.
+    """
+    cumulative = np.cumsum(histogram)
+    targets = cumulative[-1] * np.arange(1, n) / float(n)
+    cuts = np.searchsorted(cumulative, targets, side='left') + 1
+    return np.concatenate(([0], np.minimum(cuts, len(histogram)), [len(histogram)])).astype(np.int64)
+
+
+def split_by_prefix(keys, k, boundaries):
+    """indices into sorted keys where each prefix range starts (plus len(keys))"""
+    bits, shift = _prefix_layout(k)
+    inner = boundaries[1:-1].astype(np.uint64) << np.uint64(shift)
+    splits = np.searchsorted(leading_word(keys), inner, side='left')
+    return np.concatenate(([0], splits, [len(keys)])).astype(np.int64)
+
+
+def pairs_to_csr(pairs, counts, k):
+    """Converts sorted (k-mer, sample) keys and their counts to CSR by k-mer.
+
+    Returns (kmer_keys, indptr, indices, counts).
+    """
+    kmer_keys = np.zeros(len(pairs), dtype=kmer_dtype(k))
+    if k <= BASES_PER_WORD:
+        kmer_keys[:] = pairs['w0']
+    else:
+        for name in kmer_keys.dtype.names:
+            kmer_keys[name] = pairs[name]
+    first = np.ones(len(pairs), dtype=bool)
+    first[1:] = kmer_keys[1:] != kmer_keys[:-1]
+    row_starts = np.flatnonzero(first)
+    indptr = np.append(row_starts, len(pairs)).astype(np.int64)
+    return kmer_keys[row_starts], indptr, pairs['sample'].astype(np.int64), counts
+
+
+class KmerCounter(object):
+    """Accumulates packed k-mer keys and their counts.
+
+    Added keys are buffered and folded into the sorted unique table once the
+    buffer is as large as the table, so the work stays amortized linear.
+    With track_counts=False only the distinct keys are kept.
+    """
+    def __init__(self, k, track_counts=True, min_buffer=1000000):
+        self.k = k
+        self.track_counts = track_counts
+        self.min_buffer = min_buffer
+        self.keys = np.zeros(0, dtype=kmer_dtype(k))
+        self.counts = np.zeros(0, dtype=np.int64)
+        self._buffer_keys = []
+        self._buffer_counts = []
+        self._buffer_size = 0
+
+    def add(self, keys, counts=None):
+        if len(keys) == 0:
+            return
+        self._buffer_keys.append(keys)
+        if self.track_counts:
+            if counts is None:
+                counts = np.ones(len(keys), dtype=np.int64)
+            self._buffer_counts.append(counts.astype(np.int64))
+        self._buffer_size += len(keys)
+        if self._buffer_size >= max(self.min_buffer, len(self.keys)):
+            self.compact()
+
+    def merge(self, other):
+        """adds everything counted by another KmerCounter"""
+        other.compact()
+        self.add(other.keys, other.counts if self.track_counts else None)
+
+    def compact(self):
+        if self._buffer_size == 0:
+            return
+        keys = np.concatenate([self.keys] + self._buffer_keys)
+        if self.track_counts:
+            counts = np.concatenate([self.counts] + self._buffer_counts)
+            self.keys, self.counts = unique_counts(keys, counts)
+        else:
+            self.keys = np.unique(keys)
+        self._buffer_keys = []
+        self._buffer_counts = []
+        self._buffer_size = 0
+
+    def clear(self):
+        """drops all counted keys"""
+        self.keys = self.keys[:0]
+        self.counts = self.counts[:0]
+        self._buffer_keys = []
+        self._buffer_counts = []
+        self._buffer_size = 0
+
+    def nbytes(self):
+        """approximate bytes held by the table and the buffered keys"""
+        entry_bytes = self.keys.itemsize
+        if self.track_counts:
+            entry_bytes += self.counts.itemsize
+        return (len(self.keys) + self._buffer_size) * entry_bytes
+
+    def result(self):
+        """(sorted unique keys, counts); counts is None without track_counts"""
+        self.compact()
+        return self.keys, self.counts if self.track_counts else None
+
+    def __len__(self):
+        self.compact()
+        return len(self.keys)
+
+
+class SampleKmerCounter(KmerCounter):
+    """Counts k-mers per sample as one sorted array of (k-mer, sample) keys.
+
+    Memory scales with the number of non-zero sample/k-mer pairs.
+    """
+    def __init__(self, k, min_buffer=1000000):
+        KmerCounter.__init__(self, k, min_buffer=min_buffer)
+        self.keys = np.zeros(0, dtype=sample_kmer_dtype(k))
+        self.sample_ids = []
+        self._sample_index = {}
+
+    def sample_index(self, sample_id):
+        """column index of sample_id, added on first use"""
+        if sample_id not in self._sample_index:
+            self._sample_index[sample_id] = len(self.sample_ids)
+            self.sample_ids.append(sample_id)
+        return self._sample_index[sample_id]
+
+    def add_samples(self, keys, samples):
+        """adds packed k-mer keys, with samples[i] the sample index of keys[i]"""
+        pairs = np.zeros(len(keys), dtype=self.keys.dtype)
+        if self.k <= BASES_PER_WORD:
+            pairs['w0'] = keys
+        else:
+            for name in keys.dtype.names:
+                pairs[name] = keys[name]
+        pairs['sample'] = samples
+        self.add(pairs)
+
+    def sparse_result(self):
+        """Sample x k-mer counts in CSR layout with one row per k-mer.
+
+        Returns (sample_ids, kmer_keys, indptr, indices, counts): sample_ids
+        sorted, kmer_keys the sorted distinct k-mers, and the counts of row i
+        are counts[indptr[i]:indptr[i+1]] for samples indices[indptr[i]:indptr[i+1]].
+        """
+        pairs, counts = self.result()
+        kmer_keys, indptr, indices, counts = pairs_to_csr(pairs, counts, self.k)
+
+        # renumber samples in sorted-ID order and keep each row sorted by sample
+        sample_ids, rank = self.sorted_samples()
+        indices = rank[indices]
+        rows = np.repeat(np.arange(len(kmer_keys)), np.diff(indptr))
+        order = np.lexsort((indices, rows))
+        return sample_ids, kmer_keys, indptr, indices[order], counts[order]
+
+    def sorted_samples(self):
+        """(sorted sample IDs, array mapping each sample index to its sorted position)"""
+        sample_ids = sorted(self.sample_ids)
+        rank = np.zeros(len(sample_ids), dtype=np.int64)
+        rank[[self._sample_index[sample_id] for sample_id in sample_ids]] = np.arange(len(sample_ids))
+        return sample_ids, rank
@@ -2,19 +2,104 @@
 # removes line wraps in sequences
 # usage:
 # linearize_fasta.py < input.fasta > output.fasta
+# linearize_fasta.py -i input.fasta -o output.fasta -p 8
+# with --processes, byte ranges of the input starting at record boundaries
+# are linearized in parallel and concatenated in their original order
 
-from __future__ import print_function
 import sys
+import os
+import shutil
+import tempfile
+import multiprocessing
+from optparse import OptionParser
+from fasta_utils import read_fasta, record_aligned_ranges, open_output
 
-seq = ''
-for line in sys.stdin.readlines():
-    if line.startswith('>'):
+def make_option_parser():
+    parser = OptionParser(usage="usage: %prog [options] filename",
+                          version="%prog 1.0")
+    parser.add_option("-i", "--input_fasta",
+                      default=None,
+                      type='string',
+                      help="input fasta (default stdin)")
+    parser.add_option("-o","--output_fasta",
+                      type="string",
+                      default=None,
+                      help="Output filename (default stdout)",)
+    parser.add_option("-p","--processes",
+                      type="int",
+                      default=1,
+                      help="Number of worker processes; requires --input_fasta (default %default)",)
+    parser.add_option("--temp_dir",
+                      type="string",
+                      default=None,
+                      help="Directory for the per-process output parts (default system temp dir)",)
+    return parser
+
+
+def write_linear(records, output_file, buffer_size=4 * 2 ** 20):
+    """writes (header, seq) records two lines each, joining records into writes of up to
+    about buffer_size bytes; a record longer than that is written by itself"""
+    lines = []
+    nbytes = 0
+    for header, seq in records:
+        lines.append(b'>' + header + b'\n')
+        nbytes += len(header) + 2
+        if len(seq) >= buffer_size:
+            output_file.write(b''.join(lines))
+            output_file.write(seq)
+            output_file.write(b'\n')
+            lines = []
+            nbytes = 0
+            continue
         if len(seq) > 0:
-            print(seq)
-        print(line.strip())
-        seq = ''
+            lines.append(seq + b'\n')
+            nbytes += len(seq) + 1
+        if nbytes >= buffer_size:
+            output_file.write(b''.join(lines))
+            lines = []
+            nbytes = 0
+    output_file.write(b''.join(lines))
+
+
+def linearize_range(args):
+    """Pool worker: linearizes the records in one byte range into part_fp"""
+    input_fp, start, end, part_fp = args
+    part_file = open(part_fp, 'wb')
+    write_linear(read_fasta(input_fp, start, end), part_file)
+    part_file.close()
+    return part_fp
+
+
+if __name__ == '__main__':
+    parser = make_option_parser()
+    (options, args) = parser.parse_args()
+
+    if options.output_fasta is not None:
+        output_file = open_output(options.output_fasta)
+    else:
+        output_file = getattr(sys.stdout, 'buffer', sys.stdout)
+
+    if options.input_fasta is None:
+        write_linear(read_fasta(sys.stdin), output_file)
+    elif options.processes == 1:
+        write_linear(read_fasta(options.input_fasta), output_file)
     else:
-        seq += line.strip()
+        ranges = record_aligned_ranges(options.input_fasta, options.processes)
+        temp_dir = tempfile.mkdtemp(prefix='linearize_', dir=options.temp_dir)
+        pool = multiprocessing.Pool(options.processes)
+        try:
+            jobs = [(options.input_fasta, start, end, os.path.join(temp_dir, 'part%04d' %(i)))
+                    for i, (start, end) in enumerate(ranges)]
+            # parts come back in order; each is appended to the output and removed
+            for part_fp in pool.imap(linearize_range, jobs):
+                part_file = open(part_fp, 'rb')
+                shutil.copyfileobj(part_file, output_file)
+                part_file.close()
+                os.remove(part_fp)
+        finally:
+            pool.close()
+            pool.join()
+            shutil.rmtree(temp_dir)
 
-# print last seq
-print(seq)
+    if options.output_fasta is not None:
+        output_file.close()
@@ -1,14 +1,71 @@
 # launches separate usearch threads for all UDB
 # Usage:
 # parallel_usearch.py -q query.fasta -r ref_db_directory -o outfile
+# parallel_usearch.py -q query.fasta -r ref_db_directory -o outfile -n 4 -c 32 -M 200gb
+#
+# the query is read once, in chunks of --split_lines sequences kept in
+# memory, and every (chunk, database) pair is searched as a separate
+# usearch run that reads its chunk from a named pipe. Runs are
+# started while they fit in --cores (each uses --nthreads) and --max_memory
+# (each needs about its udb file size times --db_memory_factor), and
+# finished outputs are appended to outfile in (chunk, database) order.
+# Progress and time remaining are estimated from the byte offset reached
+# in the query. --chunk_files passes chunks as temporary files instead, for
+# usearch builds that cannot read their query from a pipe.
+#
+# each run's output is kept as a part file in <outfile>_parts/ next to a
+# manifest listing the finished (chunk, database) searches with the md5 of
+# their output; the directory is removed once outfile is complete. If a run
+# dies, rerunning the same command with --resume checks the listed parts
+# and only searches what is missing.
+#
+# with --derep, identical query sequences are searched once: the query is
+# collapsed to its unique sequences as it is read, and each hit is written
+# once for every query sequence sharing the hit's sequence. Since any later
+# query sequence may be a copy of one already searched, the output is then
+# written after the whole query has been read, grouped by unique sequence.
+#
+# with --best_hits identity (or bitscore), the hits of each chunk against
+# all the databases are merged as soon as the last of them is in, keeping
+# only the --max_accepts best hits per query across all databases, so the
+# output no longer grows with the number of databases.
+#
+# with --auto_split, --split_lines is only the size of the first chunk. The
+# peak RSS and run time of every usearch run are measured (from wait4's
+# rusage), and later chunks are doubled while that raises the sequences
+# searched per second, but kept small enough that no run is predicted to
+# go over --memory_target (by default --max_memory shared between the runs
+# --cores allows at once). A run that went over it halves the next chunks.
+#
+# with --columnar, outfile is written as a hit table directory (see
+# hit_table.py) of numeric and dictionary-encoded columns instead of text.
+#
+# --query_start and --query_end limit the search to the query records in a
+# byte range, e.g. one task of a run-via-qsub.py --array_query job array.
+# query and outfile may be compressed (.gz, .bz2 or .zst)
 import sys, os
+import io
+import shutil
 from optparse import OptionParser
-import multiprocessing
-from subprocess import Popen, PIPE, STDOUT
+from subprocess import Popen, STDOUT
 from collections import OrderedDict
-import math
 import time
+import errno
+import signal
+import fcntl
+import threading
+import heapq
+import hashlib
+import json
 from datetime import timedelta
+from fasta_utils import read_fasta, read_record_chunks, open_output, compression_ext, parse_memory
+from hit_table import HitTableWriter
+
+FIFO_WRITE_SIZE = 2 ** 20
+# ru_maxrss is in kilobytes, except on OS X
+MAXRSS_UNITS = 1 if sys.platform == 'darwin' else 1024
+# with --auto_split, chunks keep doubling while throughput rises at least this much
+AUTO_SPLIT_GAIN = 1.05
 
 def make_option_parser():
     parser = OptionParser(usage="usage: %prog [options] filename",
@@ -29,6 +86,55 @@ def make_option_parser():
                       default=1,
                       type='int',
                       help="Number of concurrent threads for each usearch process [default %default]")
+    parser.add_option("-c","--cores",
+                      default=None,
+                      type='int',
+                      help="Total cores for concurrent usearch runs; each run uses --nthreads [default --nthreads, i.e. one run at a time]")
+    parser.add_option("-M","--max_memory",
+                      default=None,
+                      type='string',
+                      help="Total memory for concurrent usearch runs, e.g. 200gb [default no limit]")
+    parser.add_option("--db_memory_factor",
+                      default=1.0,
+                      type='float',
+                      help="Estimated memory of a usearch run as a multiple of its udb file size [default %default]")
+    parser.add_option("--chunk_files",
+                      action="store_true",
+                      default=False,
+                      help="Write each query chunk to a temporary file for usearch instead of a named pipe (default %default)",)
+    parser.add_option("--resume",
+                      action="store_true",
+                      default=False,
+                      help="Resume an interrupted run, skipping the searches listed in its manifest whose outputs are intact (default %default)",)
+    parser.add_option("--derep",
+                      action="store_true",
+                      default=False,
+                      help="Search each distinct query sequence once and copy its hits to every identical query (default %default)",)
+    parser.add_option("--best_hits",
+                      default=None,
+                      type='choice',
+                      choices=['identity','bitscore'],
+                      help="Keep only the --max_accepts best hits per query across all databases, ranked by identity or bitscore [default all hits]")
+    parser.add_option("--auto_split",
+                      action="store_true",
+                      default=False,
+                      help="Adapt the number of sequences per chunk to measured usearch memory use and throughput, starting from --split_lines (default %default)",)
+    parser.add_option("--memory_target",
+                      default=None,
+                      type='string',
+                      help="Peak memory per usearch run to stay under with --auto_split, e.g. 16gb [default --max_memory divided by the number of concurrent runs]")
+    parser.add_option("--columnar",
+                      action="store_true",
+                      default=False,
+                      help="Write the hits as a columnar hit table directory (see hit_table.py) instead of blast6 text (default %default)",)
+    parser.add_option("--query_start",
+                      default=0,
+                      type='int',
+                      help="Byte offset of the first query record to search; must be the start of a record [default %default]")
+    parser.add_option("--query_end",
+                      default=None,
+                      type='int',
+                      help="Byte offset just past the last query record to search; must be the start of a record or the end of the file [default end of file]")
     parser.add_option("-A","--max_accepts",
                       default=2,
                       type='int',
@@ -67,10 +173,10 @@ def make_option_parser():
                       help="Path to output file [default os.path.splitext(os.path.basename(options.query))[0] + '-usearch-out.txt']",)
     return parser
 
-def run_usearch(query_fp, ref_fp, output_fp, usearch_cmd='usearch8.0',nthreads=1,
-                max_accepts=2, max_rejects=32, query_cov=1.0, target_cov=0,
-                reverse_complement=True, pct_ID=0.97,verbose=False):
-    """thread worker function"""
+def usearch_command(query_fp, ref_fp, output_fp, usearch_cmd='usearch8.0',nthreads=1,
+                    max_accepts=2, max_rejects=32, query_cov=1.0, target_cov=0,
+                    reverse_complement=True, pct_ID=0.97):
+    """usearch -usearch_global command line"""
     cmd_dict = OrderedDict()
     cmd_dict[usearch_cmd] = ''
     cmd_dict['-usearch_global'] = query_fp
@@ -88,21 +194,596 @@ def run_usearch(query_fp, ref_fp, output_fp, usearch_cmd='usearch8.0',nthreads=1
 
     cmd_dict['-threads'] = nthreads
 
-    cmd = ' '.join([key + ' ' + str(cmd_dict[key]) for key in cmd_dict])
-    if verbose:
-        print cmd
-    proc = Popen(cmd,shell=True,universal_newlines=True,stdout=PIPE,stderr=PIPE)
-    stdout, stderr = proc.communicate()
-    return_value = proc.returncode
-    return return_value, stdout, stderr
-
-def run_command(cmd, verbose=False):
-    if verbose:
-        print cmd
-    proc = Popen(cmd,shell=True,universal_newlines=True,stdout=PIPE,stderr=PIPE)
-    stdout, stderr = proc.communicate()
-    return_value = proc.returncode
-    return return_value, stdout, stderr
+    return ' '.join([key + ' ' + str(cmd_dict[key]) for key in cmd_dict])
+
+def feed_fifo(fifo_fp, text, stop):
+    """writes text into a named pipe once a reader opens it
+
+    Gives up quietly if stop is set before a reader shows up or if the
+    reader exits before reading everything.
+    """
+    while True:
+        try:
+            fd = os.open(fifo_fp, os.O_WRONLY | os.O_NONBLOCK)
+            break
+        except OSError as e:
+            if e.errno != errno.ENXIO or stop.is_set():
+                return
+            time.sleep(0.05)
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+    try:
+        pos = 0
+        while pos < len(text):
+            pos += os.write(fd, text[pos:pos + FIFO_WRITE_SIZE])
+    except OSError as e:
+        if e.errno != errno.EPIPE:
+            raise
+    finally:
+        os.close(fd)
+
+def file_md5(fp):
+    """hex md5 of a file's contents"""
+    md5 = hashlib.md5()
+    input_file = open(fp,'rb')
+    while True:
+        block = input_file.read(2 ** 20)
+        if not block:
+            break
+        md5.update(block)
+    input_file.close()
+    return md5.hexdigest()
+
+def part_name(chunk_index, ref_fp):
+    """file name of the output of one (chunk, database) search"""
+    ref_fp = os.path.abspath(ref_fp)
+    return 'chunk%06d_%s_%s.b6' %(chunk_index, os.path.basename(ref_fp), hashlib.md5(ref_fp.encode('utf-8')).hexdigest()[:8])
+
+class RunManifest(object):
+    """Records each finished (chunk, database) search so an interrupted run
+    can be resumed.
+
+    The manifest is a text file in the run's work directory. Its first line
+    holds the search parameters as JSON and each later line one finished
+    search: chunk index, numbers of the chunk's first and last query
+    sequences, reference path, part file and the part's md5. Lines
+    are flushed to disk as they are written, so a killed run loses at most
+    the searches still going.
+    """
+    def __init__(self, work_dir, params, resume=False):
+        self.work_dir = work_dir
+        self.fp = os.path.join(work_dir, 'manifest.txt')
+        self.completed = {}     # (chunk index, first, last, ref fp): part fp
+        self.chunk_sizes = {}   # chunk index: number of query sequences
+        params = json.loads(json.dumps(params))
+        if resume and os.path.exists(self.fp):
+            self._load(params)
+        else:
+            if os.path.isdir(work_dir):
+                shutil.rmtree(work_dir)
+            os.makedirs(work_dir)
+            self._append(json.dumps(params, sort_keys=True))
+
+    def _load(self, params):
+        lines = open(self.fp,'U').readlines()
+        if len(lines) == 0 or json.loads(lines[0]) != params:
+            raise ValueError('%s was written with different search parameters; rerun without --resume.' %(self.fp))
+        for line in lines[1:]:
+            if not line.endswith('\n'):
+                # cut short when the run was killed
+                continue
+            chunk_index, first, last, ref_fp, name, checksum = line.rstrip('\n').split('\t')
+            chunk_index, first, last = int(chunk_index), int(first), int(last)
+            part_fp = os.path.join(self.work_dir, name)
+            if os.path.exists(part_fp) and file_md5(part_fp) == checksum:
+                self.completed[(chunk_index, first, last, ref_fp)] = part_fp
+                self.chunk_sizes[chunk_index] = last - first + 1
+
+    def _append(self, line):
+        manifest_file = open(self.fp,'a')
+        manifest_file.write(line + '\n')
+        manifest_file.flush()
+        os.fsync(manifest_file.fileno())
+        manifest_file.close()
+
+    def add(self, chunk, ref_fp, part_fp):
+        """records a finished search whose output is part_fp"""
+        self._append('\t'.join([str(chunk.index), str(chunk.first), str(chunk.last),
+                                os.path.abspath(ref_fp), os.path.basename(part_fp), file_md5(part_fp)]))
+
+    def lookup(self, chunk, ref_fp):
+        """part file of a search finished by an earlier run, or None"""
+        return self.completed.get((chunk.index, chunk.first, chunk.last, os.path.abspath(ref_fp)))
+
+def poll_rusage(proc):
+    """(whether proc has exited, its rusage or None) for a Popen started here
+
+    The process is reaped with wait4 rather than Popen.poll so that its
+    resource usage, and that of the children it waited for, is kept.
+    """
+    if proc.returncode is not None:
+        return True, None
+    pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+    if pid == 0:
+        return False, None
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return True, rusage
+
+class ChunkSizer(object):
+    """Picks the number of query sequences in each chunk.
+
+    Chunks recorded in the manifest by an earlier run keep their size so
+    their parts can be reused; otherwise chunks get split_lines sequences.
+    With auto, that is only the first size. usearch's peak memory against
+    each database is then modelled as a fixed amount plus an amount per
+    query sequence, from the line through the peaks of its smallest and
+    largest chunks (or, until there are two sizes, taking the fixed amount
+    to be the database's file size). After each chunk of the current size
+    the size doubles if that chunk searched more sequences per second than
+    the best size so far, or goes back to the best size if not. No size
+    goes over what the memory model allows under memory_target, and a run
+    that went over memory_target halves the size.
+    """
+    def __init__(self, split_lines, auto=False, memory_target=None, replay=None):
+        self.split_lines = split_lines
+        self.auto = auto
+        self.memory_target = memory_target
+        self.replay = replay or {}
+        self.size = split_lines
+        self.growing = True
+        self.best_size = None
+        self.rates = {}         # chunk size: [sequences searched, seconds]
+        self.peaks = {}         # db index: {chunk size: peak memory}
+        self.db_bytes = {}      # db index: udb file size
+
+    def __call__(self, index):
+        return self.replay.get(index, self.size)
+
+    def _memory_limit(self):
+        """the largest chunk the memory model allows, or None"""
+        if self.memory_target is None:
+            return None
+        limit = None
+        for db_index, peaks in self.peaks.items():
+            small = min(peaks)
+            large = max(peaks)
+            if small < large:
+                per_seq = (peaks[large] - peaks[small]) / float(large - small)
+                fixed = peaks[large] - per_seq * large
+            else:
+                fixed = min(self.db_bytes[db_index], peaks[large])
+                per_seq = (peaks[large] - fixed) / float(large)
+            if per_seq <= 0:
+                continue
+            db_limit = int((self.memory_target - fixed) / per_seq)
+            if limit is None or db_limit < limit:
+                limit = db_limit
+        return limit
+
+    def _resize(self, size):
+        limit = self._memory_limit()
+        if limit is not None:
+            size = min(size, limit)
+        size = max(1, size)
+        if size != self.size:
+            print 'Chunks now have',size,'query sequences.'
+            self.size = size
+
+    def observe_run(self, nseqs, db_index, db_bytes, max_rss):
+        """records the peak memory of one usearch run"""
+        if not self.auto:
+            return
+        peaks = self.peaks.setdefault(db_index, {})
+        peaks[nseqs] = max(peaks.get(nseqs, 0), max_rss)
+        self.db_bytes[db_index] = db_bytes
+        if self.memory_target is not None and max_rss > self.memory_target:
+            self.growing = False
+            self._resize(nseqs // 2)
+        else:
+            self._resize(self.size)
+
+    def observe_chunk(self, nseqs, nruns, seconds):
+        """records the time taken by all the runs of a chunk"""
+        if not self.auto or seconds <= 0:
+            return
+        rate = self.rates.setdefault(nseqs, [0, 0.0])
+        rate[0] += nseqs * nruns
+        rate[1] += seconds
+        if nseqs != self.size:
+            return
+        speed = rate[0] / rate[1]
+        if self.best_size is None or speed >= self.rates[self.best_size][0] / self.rates[self.best_size][1] * AUTO_SPLIT_GAIN:
+            self.best_size = nseqs
+            if self.growing:
+                self._resize(nseqs * 2)
+        else:
+            self.growing = False
+            self._resize(self.best_size)
+
+class QueryChunk(object):
+    """query records held in memory while they are searched"""
+    def __init__(self, index, text, first, last, start, end):
+        self.index = index
+        self.text = text
+        self.first = first      # number of the first and last query sequences
+        self.last = last
+        self.start = start      # byte offsets of the part of the query read for the chunk
+        self.end = end
+        self.fp = None          # temporary file, with --chunk_files
+        self.nleft = 0          # runs not yet finished
+        self.seconds = 0        # total time of the finished runs
+        self.nruns = 0          # runs needed by this search, not resumed
+
+    def __len__(self):
+        return self.last - self.first + 1
+
+def query_chunks(query_fp, chunk_size, start=0, end=None):
+    """yields a QueryChunk for each run of chunk_size(chunk index) query sequences
+    in the bytes [start, end) of the query
+
+    The query is read once, in a single pass, with no count beforehand.
+    """
+    seqcount = 0
+    for index, (text, nrecords, end) in enumerate(read_record_chunks(query_fp, chunk_size, start, end)):
+        yield QueryChunk(index, text, seqcount + 1, seqcount + nrecords, start, end)
+        seqcount += nrecords
+        start = end
+
+class Dereplicator(object):
+    """Collapses identical query sequences.
+
+    Sequences are keyed by the md5 of their upper-cased bases, which maps to
+    the sequence's number among the unique ones; members[n] lists the
+    headers of every query sequence identical to unique sequence n. Unique
+    sequences are searched under their number as label.
+    """
+    def __init__(self):
+        self.uniques = {}
+        self.members = []
+        self.nseqs = 0
+
+    def add(self, header, seq):
+        """the unique sequence's number if seq is new, otherwise None"""
+        self.nseqs += 1
+        key = hashlib.md5(seq.upper()).digest()
+        n = self.uniques.get(key)
+        if n is not None:
+            self.members[n].append(header)
+            return None
+        n = len(self.members)
+        self.uniques[key] = n
+        self.members.append([header])
+        return n
+
+    def chunks(self, query_fp, chunk_size, read_size, start=0, end=None):
+        """yields a QueryChunk for each run of chunk_size(chunk index) unique
+        sequences in the bytes [start, end) of the query, reading read_size
+        query sequences at a time
+
+        A chunk's bytes run up to the start of the next chunk's first
+        sequence, so duplicates are counted with the chunk before them. A
+        sequence's start is estimated from its position among the records
+        of the read, so the chunks cut from one read share its bytes.
+        """
+        index = 0
+        # (record text, estimated start offset) of each unique sequence not yet in a chunk
+        pending = []
+        read_start = start
+        for text, nrecords, end in read_record_chunks(query_fp, read_size, start, end):
+            records = list(read_fasta(io.BytesIO(text)))
+            for i, (header, seq) in enumerate(records):
+                n = self.add(header, seq)
+                if n is not None:
+                    seq_start = read_start + (end - read_start) * i // len(records)
+                    pending.append((b'>%d\n%s\n' %(n, seq), seq_start))
+            read_start = end
+            # a chunk is cut once the sequence after it has been read
+            size = chunk_size(index)
+            while len(pending) > size:
+                first = len(self.members) - len(pending) + 1
+                chunk_end = pending[size][1]
+                yield QueryChunk(index, b''.join([record for record, seq_start in pending[:size]]),
+                                 first, first + size - 1, start, chunk_end)
+                index += 1
+                start = chunk_end
+                pending = pending[size:]
+                size = chunk_size(index)
+        if len(pending) > 0:
+            first = len(self.members) - len(pending) + 1
+            yield QueryChunk(index, b''.join([record for record, seq_start in pending]),
+                             first, len(self.members), start, end)
+
+    def expand(self, lines, output_file):
+        """writes each blast6 hit line once for every member of its query"""
+        for line in lines:
+            label, hit = line.split(b'\t', 1)
+            for header in self.members[int(label)]:
+                output_file.write(header + b'\t' + hit)
+
+# blast6 columns ranking hits for --best_hits, the second breaking ties
+BLAST6_RANK_COLUMNS = {'identity': (2, 11), 'bitscore': (11, 2)}
+
+def best_hits(part_files, max_accepts, rank='identity'):
+    """yields the max_accepts best blast6 hits of each query in part_files
+
+    Each query keeps a heap of its best hits so far; equally ranked hits go
+    to the earlier file and line. Queries come out in order of their first
+    hit, each query's hits best first.
+    """
+    columns = BLAST6_RANK_COLUMNS[rank]
+    heaps = OrderedDict()
+    order = 0
+    for part_file in part_files:
+        for line in part_file:
+            fields = line.split(b'\t')
+            key = tuple([float(fields[column]) for column in columns]) + (-order,)
+            order += 1
+            heap = heaps.get(fields[0])
+            if heap is None:
+                heap = heaps[fields[0]] = []
+            if len(heap) < max_accepts:
+                heapq.heappush(heap, (key, line))
+            elif key > heap[0][0]:
+                heapq.heapreplace(heap, (key, line))
+    for heap in heaps.values():
+        for key, line in sorted(heap, reverse=True):
+            yield line
+
+class SearchRun(object):
+    """one usearch process searching one query chunk against one database"""
+    def __init__(self, chunk, db_index, output_fp):
+        self.chunk = chunk
+        self.db_index = db_index
+        self.output_fp = output_fp
+        self.log_fp = output_fp + '.log'
+        self.fifo_fp = None
+        self.feeder = None
+        self.stop = threading.Event()
+        self.proc = None
+        self.started = None
+
+    def cleanup(self):
+        """stops the process and pipe feeder if still going and removes the run's files"""
+        self.stop.set()
+        if self.proc is not None and self.proc.poll() is None:
+            # the shell and usearch share the process group started for them
+            os.killpg(self.proc.pid, signal.SIGKILL)
+            self.proc.wait()
+        if self.feeder is not None:
+            self.feeder.join()
+        for fp in [self.fifo_fp, self.output_fp, self.log_fp]:
+            if fp is not None and os.path.exists(fp):
+                os.remove(fp)
+
+class SearchScheduler(object):
+    """Runs usearch on every (query chunk, database) pair within a core and
+    memory budget.
+
+    Runs are started in (chunk, database) order, skipping ahead to the first
+    one that fits when the next one's database does not; a run that does not
+    fit at all is started once nothing else is running. Searches the
+    manifest already lists are not run again. Chunks are only read
+    when a run is about to need them and are kept in memory until all their
+    runs finish; each run reads its chunk from its own named pipe (or, with
+    --chunk_files, from a temporary file). Each run writes its own part file
+    in the manifest's work directory, and finished parts are appended to
+    output_file in (chunk, database) order as soon as all earlier ones are in.
+    """
+    def __init__(self, ref_fps, options, output_file, manifest, sizer, query_size=None,
+                 dereplicator=None, poll_interval=0.2):
+        self.ref_fps = ref_fps
+        self.options = options
+        self.output_file = output_file
+        self.manifest = manifest
+        self.dereplicator = dereplicator
+        self.sizer = sizer
+        self.query_read = False
+        self.work_dir = manifest.work_dir
+        self.query_size = query_size
+        self.poll_interval = poll_interval
+        self.cores = options.cores
+        if self.cores is None:
+            self.cores = options.nthreads
+        self.max_memory = None
+        if options.max_memory is not None:
+            self.max_memory = parse_memory(options.max_memory)
+        self.db_memory = [os.path.getsize(ref_fp) * options.db_memory_factor
+                          if os.path.exists(ref_fp) else 0 for ref_fp in ref_fps]
+        self.waiting = []       # (chunk, db index) not yet started
+        self.running = []       # SearchRuns
+        self.finished = {}      # (chunk index, db index): part fp
+        self.chunks = {}        # chunk index: QueryChunk with runs not yet finished
+        self.next_output = (0, 0)
+        self.cores_used = 0
+        self.memory_used = 0
+        self.searched_bytes = 0
+        self.resumed_bytes = 0
+        self.starttime = time.time()
+
+    def _fits(self, db_index):
+        if len(self.running) == 0:
+            return True
+        if self.cores_used + self.options.nthreads > self.cores:
+            return False
+        return self.max_memory is None or self.memory_used + self.db_memory[db_index] <= self.max_memory
+
+    def _progress(self, chunk, db_index):
+        elapsedtime = time.time() - self.starttime
+        elapsedtimestr = str(timedelta(seconds=round(elapsedtime)))
+        # the share of the query already searched, from byte offsets
+        if self.query_size and self.searched_bytes > 0:
+            done = self.searched_bytes / float(self.query_size * len(self.ref_fps) - self.resumed_bytes)
+            remtime = elapsedtime / done * (1 - done)
+            remtimestr = str(timedelta(seconds=round(remtime)))
+        else:
+            remtimestr = 'Unknown time'
+        seqs = "query sequences"
+        if self.dereplicator is not None:
+            seqs = "unique query sequences"
+        print elapsedtimestr, "searching %s %d-%d" %(seqs, chunk.first, chunk.last),'against ref', db_index+1,'of',str(len(self.ref_fps)) + ';',remtimestr,'remaining.'
+
+    def _start(self, chunk, db_index):
+        options = self.options
+        self._progress(chunk, db_index)
+        run = SearchRun(chunk, db_index, os.path.join(self.work_dir, part_name(chunk.index, self.ref_fps[db_index]) + '.tmp'))
+        if options.chunk_files:
+            if chunk.fp is None:
+                chunk.fp = os.path.join(self.work_dir, 'query%06d.tmp' %(chunk.index))
+                chunk_file = open(chunk.fp,'wb')
+                chunk_file.write(chunk.text)
+                chunk_file.close()
+            query_fp = chunk.fp
+        else:
+            run.fifo_fp = run.output_fp[:-len('.tmp')] + '.fifo'
+            os.mkfifo(run.fifo_fp)
+            query_fp = run.fifo_fp
+        cmd = usearch_command(query_fp, self.ref_fps[db_index], run.output_fp,
+                              usearch_cmd=options.usearch_command,
+                              nthreads=options.nthreads,
+                              max_accepts=options.max_accepts,
+                              max_rejects=options.max_rejects,
+                              query_cov=options.query_coverage,
+                              target_cov=options.target_coverage,
+                              reverse_complement=options.reverse_complement,
+                              pct_ID=options.pct_ID)
+        if options.verbose:
+            print cmd
+        self.running.append(run)
+        # usearch's progress output goes to a log file so its pipe never fills
+        log_file = open(run.log_fp,'w')
+        run.started = time.time()
+        run.proc = Popen(cmd,shell=True,stdout=log_file,stderr=STDOUT,preexec_fn=os.setsid)
+        log_file.close()
+        if run.fifo_fp is not None:
+            run.feeder = threading.Thread(target=feed_fifo, args=(run.fifo_fp, chunk.text, run.stop))
+            run.feeder.start()
+        self.cores_used += options.nthreads
+        self.memory_used += self.db_memory[db_index]
+
+    def _collect(self):
+        """waits for at least one run to finish and records the finished ones"""
+        while True:
+            done = []
+            for run in self.running:
+                exited, rusage = poll_rusage(run.proc)
+                if exited:
+                    done.append((run, rusage))
+            if len(done) > 0:
+                break
+            time.sleep(self.poll_interval)
+        for run, rusage in done:
+            self.running.remove(run)
+            self.cores_used -= self.options.nthreads
+            self.memory_used -= self.db_memory[run.db_index]
+            chunk = run.chunk
+            if run.proc.returncode != 0:
+                self.running.append(run)
+                sys.stderr.write('Warning: usearch run on query sequences %d-%d and ref DB %s failed with the following error output:\n' %(chunk.first, chunk.last, self.ref_fps[run.db_index]))
+                sys.stderr.write(open(run.log_fp,'U').read() + '\n')
+                raise ValueError('USEARCH error - if USEARCH ran out of memory, decrease --split_lines or --max_memory.')
+            # the output is kept as a part file; the rest of the run's files are not
+            part_fp = run.output_fp[:-len('.tmp')]
+            os.rename(run.output_fp, part_fp)
+            run.output_fp = None
+            run.cleanup()
+            self.manifest.add(chunk, self.ref_fps[run.db_index], part_fp)
+            self.searched_bytes += chunk.end - chunk.start
+            self.finished[(chunk.index, run.db_index)] = part_fp
+            seconds = time.time() - run.started
+            chunk.seconds += seconds
+            self.sizer.observe_run(len(chunk), run.db_index, self.db_memory[run.db_index],
+                                   rusage.ru_maxrss * MAXRSS_UNITS)
+            chunk.nleft -= 1
+            if chunk.nleft == 0:
+                self.sizer.observe_chunk(len(chunk), chunk.nruns, chunk.seconds)
+                if chunk.fp is not None:
+                    os.remove(chunk.fp)
+                del self.chunks[chunk.index]
+
+    def _write_finished(self):
+        """appends finished parts to the output file in (chunk, database) order
+
+        With --best_hits a chunk's parts are reduced together once all are
+        in. Dereplicated hits are only written once the whole query has been
+        read.
+        """
+        if self.dereplicator is not None and not self.query_read:
+            return
+        while self.next_output in self.finished:
+            chunk_index, db_index = self.next_output
+            if self.options.best_hits is None:
+                part_fps = [self.finished.pop(self.next_output)]
+            else:
+                keys = [(chunk_index, i) for i in range(len(self.ref_fps))]
+                if not all([key in self.finished for key in keys]):
+                    break
+                part_fps = [self.finished.pop(key) for key in keys]
+                db_index = len(self.ref_fps) - 1
+            part_files = [open(part_fp,'rb') for part_fp in part_fps]
+            if self.options.best_hits is not None:
+                lines = best_hits(part_files, self.options.max_accepts, self.options.best_hits)
+            else:
+                lines = part_files[0]
+            if self.dereplicator is not None:
+                self.dereplicator.expand(lines, self.output_file)
+            elif self.options.best_hits is not None:
+                for line in lines:
+                    self.output_file.write(line)
+            else:
+                shutil.copyfileobj(part_files[0], self.output_file)
+            for part_file in part_files:
+                part_file.close()
+            if db_index + 1 < len(self.ref_fps):
+                self.next_output = (chunk_index, db_index + 1)
+            else:
+                self.next_output = (chunk_index + 1, 0)
+
+    def run(self, chunks):
+        """searches every QueryChunk from an iterator"""
+        chunks = iter(chunks)
+        chunks_left = True
+        try:
+            while True:
+                # read the next chunk only when a run could start on it
+                if len(self.waiting) == 0 and chunks_left and self._fits(0):
+                    try:
+                        chunk = next(chunks)
+                    except StopIteration:
+                        chunks_left = False
+                        self.query_read = True
+                    else:
+                        for db_index, ref_fp in enumerate(self.ref_fps):
+                            part_fp = self.manifest.lookup(chunk, ref_fp)
+                            if part_fp is None:
+                                self.waiting.append((chunk, db_index))
+                            else:
+                                self.finished[(chunk.index, db_index)] = part_fp
+                                self.resumed_bytes += chunk.end - chunk.start
+                        chunk.nleft = chunk.nruns = len(self.waiting)
+                        if chunk.nleft > 0:
+                            self.chunks[chunk.index] = chunk
+                        self._write_finished()
+                startable = [job for job in self.waiting if self._fits(job[1])]
+                if len(startable) > 0:
+                    self.waiting.remove(startable[0])
+                    self._start(*startable[0])
+                    continue
+                if len(self.running) == 0:
+                    if len(self.waiting) == 0 and not chunks_left:
+                        break
+                    continue
+                self._collect()
+                self._write_finished()
+            self._write_finished()
+        finally:
+            for run in self.running:
+                run.cleanup()
+            self.running = []
+            for chunk in self.chunks.values():
+                if chunk.fp is not None and os.path.exists(chunk.fp):
+                    os.remove(chunk.fp)
 
 def check_command_args(options, args):
     required = ['query','ref','output_fp']
@@ -119,8 +800,6 @@ if __name__ == '__main__':
         options.output_fp = os.path.splitext(os.path.basename(options.query))[0] + '-usearch-out.txt'
     check_command_args(options, args)
 
-    processes = []
-
     if os.path.isdir(options.ref):
         ref_fps = []
         for fp in os.listdir(options.ref):
@@ -130,70 +809,58 @@ if __name__ == '__main__':
     else:
         ref_fps = options.ref.strip().split(',')
 
-    retvals = [''] * len(ref_fps)
-    stdouts = [''] * len(ref_fps)
-    stderrs = [''] * len(ref_fps)
+    print len(ref_fps),'reference databases.'
 
-    output_fps = [options.output_fp + '%03d' %(i) for i in xrange(len(ref_fps))]
-    
-    # write query file out in batches; do search on each one.
-    nseqs = 0
-    for line in open(options.query,'U'):
-        if line[0] == '>':
-            nseqs += 1
-    
-    print nseqs,'query sequences and',len(ref_fps),'reference databases.'
-
-    starttime = time.time()
-    seqcount = 0
-    output_file = open(options.output_fp,'w')
-    tmp_query_fp = options.output_fp + '_partial_query.tmp'
-    tmp_query_file = open(tmp_query_fp,'w')
-    tmp_output_fp = options.output_fp + '_partial_output.tmp'
-    header = ''
-    totalsearches = math.ceil(nseqs/min(nseqs,options.split_lines)) * len(ref_fps)
-    nsearches = 0
-    for line in open(options.query,'U'):
-        tmp_query_file.write(line)
-        if not line[0] == '>':
-            seqcount += 1
-            if seqcount % options.split_lines == 0 or seqcount == nseqs:
-                tmp_query_file.close()
-
-                for i, ref_fp in enumerate(ref_fps):
-                    currtime = time.time()
-                    elapsedtime = currtime - starttime
-                    elapsedtimestr = str(timedelta(seconds=round(elapsedtime)))
-                    if nsearches > 0:
-                        remtime = elapsedtime / float(nsearches) * (totalsearches - nsearches)
-                        remtimestr = str(timedelta(seconds=round(remtime)))
-                    else:
-                        remtimestr = 'Unknown time'
-                    print elapsedtimestr, "searching query sequence",seqcount,'of',nseqs,'against ref', i+1,'of',str(len(ref_fps)) + ';',remtimestr,'remaining.'
-                    retvals[i], stdouts[i], stderrs[i] = \
-                        run_usearch(tmp_query_fp, 
-                                ref_fp, tmp_output_fp, 
-                                usearch_cmd=options.usearch_command,
-                                nthreads=options.nthreads,
-                                max_accepts=options.max_accepts,
-                                max_rejects=options.max_rejects,
-                                query_cov=options.query_coverage,
-                                target_cov=options.target_coverage,
-                                reverse_complement=options.reverse_complement,
-                                pct_ID=options.pct_ID, verbose=options.verbose)
-                    nsearches += 1
-                    if retvals[i] != 0:
-                        sys.stderr.write('Warning: usearch run %d on ref DB %s failed with the following error output:\n' %(i, ref_fp))
-                        sys.stderr.write(stderrs[i] + '\n')
-                        raise ValueError('USEARCH error - if USEARCH ran out of memory, decrease --split_lines.')
-                    else:
-                        for line in open(tmp_output_fp,'U'):
-                            output_file.write(line)
-                if seqcount < nseqs:
-                    # if there are more seqs to search, reopen the temp query file
-                    tmp_query_file = open(tmp_query_fp,'w')
-
-    # remove temp output files and query files
-    os.remove(tmp_query_fp)
-    os.remove(tmp_output_fp)
+    query_size = None
+    if compression_ext(options.query) is None:
+        query_size = os.path.getsize(options.query)
+        if options.query_end is not None:
+            query_size = options.query_end
+        query_size -= options.query_start
+    elif options.query_start != 0 or options.query_end is not None:
+        raise ValueError('A compressed query cannot be searched by byte range.')
+    # anything that changes which hits a search finds must match to resume
+    params = {'query': os.path.abspath(options.query),
+              'query_bytes': os.path.getsize(options.query),
+              'split_lines': options.split_lines,
+              'usearch_command': options.usearch_command,
+              'max_accepts': options.max_accepts,
+              'max_rejects': options.max_rejects,
+              'pct_ID': options.pct_ID,
+              'query_coverage': options.query_coverage,
+              'target_coverage': options.target_coverage,
+              'reverse_complement': options.reverse_complement,
+              'derep': options.derep,
+              'query_start': options.query_start,
+              'query_end': options.query_end}
+    manifest = RunManifest(options.output_fp + '_parts', params, options.resume)
+    if options.resume:
+        print len(manifest.completed),'searches already finished.'
+    # a walltime kill still stops the usearch runs, which have their own process groups
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit('Terminated.'))
+    if options.columnar:
+        output_file = HitTableWriter(options.output_fp)
+    else:
+        output_file = open_output(options.output_fp)
+    memory_target = None
+    if options.memory_target is not None:
+        memory_target = parse_memory(options.memory_target)
+    elif options.max_memory is not None:
+        cores = options.cores
+        if cores is None:
+            cores = options.nthreads
+        memory_target = parse_memory(options.max_memory) // max(1, cores // options.nthreads)
+    sizer = ChunkSizer(options.split_lines, options.auto_split, memory_target, manifest.chunk_sizes)
+    if options.derep:
+        dereplicator = Dereplicator()
+        chunks = dereplicator.chunks(options.query, sizer, options.split_lines,
+                                     options.query_start, options.query_end)
+    else:
+        dereplicator = None
+        chunks = query_chunks(options.query, sizer, options.query_start, options.query_end)
+    scheduler = SearchScheduler(ref_fps, options, output_file, manifest, sizer, query_size, dereplicator)
+    scheduler.run(chunks)
     output_file.close()
+    if options.derep:
+        print dereplicator.nseqs,'query sequences,',len(dereplicator.members),'unique.'
+    shutil.rmtree(manifest.work_dir)
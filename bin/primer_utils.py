@@ -0,0 +1,144 @@
+# in-process degenerate primer matching for trim_fasta_by_primers.py
+#
+# primers may use IUPAC ambiguity codes; a primer position matches a read
+# base when their codes share a base. Matches allow up to max_errors
+# mismatches, insertions or deletions (edit distance) using Myers'
+# bit-vector algorithm: the primer's DP column is held in the bits of one
+# uint64 (primers up to 64 bases), and a whole batch of reads is advanced
+# one read position at a time with numpy, so the python loop runs once per
+# read position, not once per read base.
+
+import numpy as np
+
+IUPAC_BASES = {'A': 'A', 'C': 'C', 'G': 'G', 'T': 'T', 'U': 'T',
+               'R': 'AG', 'Y': 'CT', 'S': 'CG', 'W': 'AT', 'K': 'GT', 'M': 'AC',
+               'B': 'CGT', 'D': 'AGT', 'H': 'ACT', 'V': 'ACG', 'N': 'ACGT'}
+
+IUPAC_COMPLEMENTS = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A', 'U': 'A',
+                     'R': 'Y', 'Y': 'R', 'S': 'S', 'W': 'W', 'K': 'M', 'M': 'K',
+                     'B': 'V', 'D': 'H', 'H': 'D', 'V': 'B', 'N': 'N'}
+
+MAX_PRIMER_LENGTH = 64
+PAD_CODE = 0
+MAX_MATRIX_BYTES = 16 * 2 ** 20
+
+
+def reverse_complement(seq):
+    """reverse complement of a sequence that may contain IUPAC codes"""
+    return ''.join([IUPAC_COMPLEMENTS[base] for base in seq.upper()[::-1]])
+
+
+def encode_reads(seqs, reverse=False):
+    """(reads x max length uint8 matrix of bytes, lengths), padded with PAD_CODE
+
+    With reverse=True each read is reversed first.
+    """
+    lengths = np.array([len(seq) for seq in seqs], dtype=np.int64)
+    if reverse:
+        seqs = [seq[::-1] for seq in seqs]
+    matrix = np.zeros((len(seqs), max(1, int(lengths.max()) if len(seqs) > 0 else 1)), dtype=np.uint8)
+    if lengths.sum() > 0:
+        flat = np.frombuffer(b''.join(seqs), dtype=np.uint8)
+        rows = np.repeat(np.arange(len(seqs)), lengths)
+        offsets = np.cumsum(lengths) - lengths
+        cols = np.arange(len(flat)) - np.repeat(offsets, lengths)
+        matrix[rows, cols] = flat
+    return matrix, lengths
+
+
+def length_groups(lengths, max_bytes=MAX_MATRIX_BYTES):
+    """yields arrays of read indices grouped by length, shortest reads first
+
+    Each group's encode_reads matrix (reads x longest read) is at most
+    max_bytes, or the group is a single read, so a few long reads do not
+    pad every read of a batch to their length.
+    """
+    order = np.argsort(lengths, kind='mergesort')
+    sorted_lengths = np.maximum(np.asarray(lengths, dtype=np.int64)[order], 1)
+    start = 0
+    while start < len(order):
+        # sorted, so a group's matrix size grows with each read added
+        sizes = np.arange(1, len(order) - start + 1) * sorted_lengths[start:]
+        end = start + max(1, int(np.searchsorted(sizes, max_bytes, side='right')))
+        yield order[start:end]
+        start = end
+
+
+class PrimerMatcher(object):
+    """Finds the best match of one degenerate primer in each of a batch of reads.
+
+    With reverse=True the primer is matched against the reversed reads, so
+    the position reported is where the match starts rather than ends.
+    """
+    def __init__(self, primer, max_errors=1, reverse=False):
+        primer = primer.upper()
+        if len(primer) > MAX_PRIMER_LENGTH:
+            raise ValueError('Primers can be at most %d bases: %s' %(MAX_PRIMER_LENGTH, primer))
+        for base in primer:
+            if base not in IUPAC_BASES:
+                raise ValueError('Primer %s has a non-IUPAC character %s' %(primer, base))
+        self.primer = primer
+        self.max_errors = max_errors
+        self.reverse = reverse
+        pattern = primer
+        if reverse:
+            pattern = primer[::-1]
+        self.length = len(pattern)
+        # peq[byte] has bit i set if read byte can match pattern position i
+        self.peq = np.zeros(256, dtype=np.uint64)
+        for code, read_bases in IUPAC_BASES.items():
+            bits = 0
+            for i, primer_base in enumerate(pattern):
+                if set(read_bases) & set(IUPAC_BASES[primer_base]):
+                    bits |= 1 << i
+            self.peq[ord(code)] = bits
+            self.peq[ord(code.lower())] = bits
+
+    def match(self, matrix, lengths):
+        """(edit distance, position) of each read's best match, or (-1, -1) if none
+        is within max_errors
+
+        matrix and lengths are from encode_reads, reversed if the matcher is.
+        The position is the index just past the match for forward matchers and
+        the index of the match's first base for reverse ones. Ties go to the
+        match nearest the start of the scanned read, taking the last of a run
+        of equally good adjacent ends.
+        """
+        nreads, ncols = matrix.shape
+        m = self.length
+        mask = np.uint64((1 << m) - 1)
+        high = np.uint64(1 << (m - 1))
+        one = np.uint64(1)
+        pv = np.empty(nreads, dtype=np.uint64)
+        pv.fill(mask)
+        mv = np.zeros(nreads, dtype=np.uint64)
+        score = np.empty(nreads, dtype=np.int64)
+        score.fill(m)
+        best = np.empty(nreads, dtype=np.int64)
+        best.fill(self.max_errors + 1)
+        best_col = np.empty(nreads, dtype=np.int64)
+        best_col.fill(-1)
+        for j in range(ncols):
+            eq = self.peq[matrix[:, j]]
+            xv = eq | mv
+            xh = (((eq & pv) + pv) ^ pv) | eq
+            ph = mv | (~(xh | pv) & mask)
+            mh = pv & xh
+            score += (ph & high) != 0
+            score -= (mh & high) != 0
+            ph = (ph << one) & mask
+            mh = (mh << one) & mask
+            pv = mh | (~(xv | ph) & mask)
+            mv = ph & xv
+            # a run of equally good ends usually comes from a mismatch at the
+            # primer's last base; its last end is the ungapped alignment
+            better = (score < best) | ((score == best) & (best_col == j - 1))
+            better &= (score <= self.max_errors) & (j < lengths)
+            best[better] = score[better]
+            best_col[better] = j
+        found = best_col >= 0
+        positions = np.where(found, best_col + 1, -1)
+        if self.reverse:
+            positions[found] = lengths[found] - 1 - best_col[found]
+        best[~found] = -1
+        return best, positions
@@ -6,6 +6,17 @@
 # 
 # or for default settings:
 # run_via_qsub.py -command "command goes here; another command" 
+#
+# job array mode: splits a fasta query into --array_tasks byte ranges that
+# start at records (and, with --array_refs, pairs each with every reference
+# database), then submits one '#PBS -t' array script with a task per range
+# (or per range and database) and a merge job that runs once every task
+# has succeeded (-W depend=afterokarray). Each task runs --command with
+# QUERY_START, QUERY_END, REF and PART set; PART is the file the task must
+# write, and the merge job concatenates the parts into --array_output in
+# task order:
+# run_via_qsub.py -N search --array_query q.fna --array_tasks 50 --array_refs ref_dir --ppn 8 \
+#   --array_output hits.txt --command 'parallel_usearch.py -q q.fna --query_start $QUERY_START --query_end $QUERY_END -r $REF -o $PART -n 8'
 
 
 from __future__ import division
@@ -17,6 +28,7 @@ from optparse import OptionParser
 import random
 import string
 from subprocess import Popen, PIPE
+from fasta_utils import record_aligned_ranges, compression_ext
 
 def make_option_parser():
     parser = OptionParser(usage="usage: %prog [options] filename",
@@ -57,6 +69,22 @@ def make_option_parser():
                       default=None,
                       type='string',
                       help="Email address; if provided, sends emails at abort, begin, and end (default None)")    
+    parser.add_option("-a", "--array_query",
+                      default=None,
+                      type='string',
+                      help="Run --command as a job array over byte ranges of this fasta file (default None)")
+    parser.add_option("-t", "--array_tasks",
+                      default=10,
+                      type='int',
+                      help="Number of byte ranges the --array_query is split into (default %default)")
+    parser.add_option("-r", "--array_refs",
+                      default=None,
+                      type='string',
+                      help="Directory of .udb files or comma-separated list of databases; with --array_query, runs one task per byte range and database (default one task per byte range)")
+    parser.add_option("-O", "--array_output",
+                      default=None,
+                      type='string',
+                      help="File the merge job concatenates the array task parts into (default <out_basedir>/<name>_output.txt)")
     parser.add_option("-P", "--print_only",
                       action="store_true",
                       default=False,
@@ -68,6 +96,116 @@ def make_option_parser():
     return parser
 
 
+def pbs_header(options, name, stdout_fp, stderr_fp):
+    """#PBS lines shared by the scripts this submits"""
+    pbs_lines = []
+    pbs_lines.append('#!/bin/bash -l')
+    pbs_lines.append('#PBS -l walltime=%s,nodes=%d:ppn=%d,mem=%s' %(options.wallclock,options.nodes,options.ppn,options.mem))
+
+    if options.email is not None:
+        pbs_lines.append('#PBS -M %s' %(options.email))
+        pbs_lines.append('#PBS -m abe')
+    pbs_lines.append('#PBS -N %s' %(name))
+    pbs_lines.append('#PBS -o %s' %(stdout_fp))
+    pbs_lines.append('#PBS -e %s' %(stderr_fp))
+    pbs_lines.append('#PBS -q %s' %(options.queue))
+    return pbs_lines
+
+
+def write_pbs(pbs_fp, pbs_lines):
+    pbs_f = open(pbs_fp,'w')
+    pbs_f.write('\n'.join(pbs_lines) + '\n')
+    pbs_f.close()
+
+
+def run_qsub(cmd, options):
+    """prints and, unless --print_only, runs a qsub command; returns the job id"""
+    print('qsub command is: ' + cmd)
+    if options.print_only:
+        return None
+    print('Running qsub...')
+
+    proc = Popen(cmd,shell=True,universal_newlines=True,stdout=PIPE,stderr=PIPE)
+    stdout, stderr = proc.communicate()
+    print(stdout)
+    if len(stderr) > 0:
+        print('\nStandard err was:\n' + stderr)
+    return stdout.strip()
+
+
+def array_tasks(options, parts_dir):
+    """(query start, query end, part, ref) for each task of an --array_query job
+
+    part and ref are absolute paths; ref is empty without --array_refs.
+    """
+    if compression_ext(options.array_query) is not None:
+        raise ValueError('A compressed --array_query cannot be split into byte ranges; decompress it first.')
+    ranges = record_aligned_ranges(options.array_query, options.array_tasks)
+    refs = ['']
+    if options.array_refs is not None:
+        if os.path.isdir(options.array_refs):
+            refs = sorted([os.path.join(options.array_refs, fp) for fp in os.listdir(options.array_refs)
+                           if fp.endswith('.udb')])
+        else:
+            refs = options.array_refs.strip().split(',')
+        refs = [os.path.abspath(ref) for ref in refs]
+    tasks = []
+    for start, end in ranges:
+        for ref in refs:
+            part_fp = os.path.join(parts_dir, 'part%06d' %(len(tasks)))
+            tasks.append((start, end, part_fp, ref))
+    return tasks
+
+
+def submit_array(options, stdout_fp, stderr_fp):
+    """writes and submits the array script and its merge job"""
+    # jobs start in $HOME, so the scripts only use absolute paths and cd to
+    # the submission directory for --command's relative paths
+    parts_dir = os.path.abspath(os.path.join(options.out_basedir, options.name + '_parts'))
+    if not os.path.exists(parts_dir):
+        os.makedirs(parts_dir)
+    if options.array_output is None:
+        options.array_output = os.path.join(options.out_basedir, options.name + '_output.txt')
+    array_output = os.path.abspath(options.array_output)
+    tasks = array_tasks(options, parts_dir)
+    tasks_fp = os.path.abspath(os.path.join(options.out_basedir, options.name + '_tasks.txt'))
+    tasks_f = open(tasks_fp,'w')
+    for task in tasks:
+        tasks_f.write('\t'.join([str(x) for x in task]) + '\n')
+    tasks_f.close()
+    if options.verbose:
+        print('%d array tasks listed in %s' %(len(tasks), tasks_fp))
+
+    # task i runs with the values on line i + 1 of the task file; REF comes
+    # last since read merges the tabs around an empty field
+    pbs_lines = pbs_header(options, options.name, stdout_fp, stderr_fp)
+    pbs_lines.append('#PBS -t 0-%d' %(len(tasks) - 1))
+    pbs_lines.append('cd "$PBS_O_WORKDIR"')
+    pbs_lines.append('IFS=$\'\\t\' read -r QUERY_START QUERY_END PART REF <<< "$(sed -n "$((PBS_ARRAYID + 1))p" %s)"' %(tasks_fp))
+    pbs_lines.append('export QUERY_START QUERY_END PART REF')
+    pbs_lines.append(options.command)
+    pbs_fp = os.path.join(options.out_basedir,options.name + '.pbs')
+    write_pbs(pbs_fp, pbs_lines)
+
+    merge_name = options.name + '_merge'
+    merge_lines = pbs_header(options, merge_name,
+                             os.path.join(options.out_basedir, merge_name + '_stdout.txt'),
+                             os.path.join(options.out_basedir, merge_name + '_stderr.txt'))
+    merge_lines.append('set -e -o pipefail')
+    merge_lines.append('cd "$PBS_O_WORKDIR"')
+    merge_lines.append('cut -f3 %s | while IFS= read -r part; do cat "$part"; done > %s' %(tasks_fp, array_output))
+    merge_lines.append('rm -r %s' %(parts_dir))
+    merge_fp = os.path.join(options.out_basedir, merge_name + '.pbs')
+    write_pbs(merge_fp, merge_lines)
+
+    job_id = run_qsub('qsub ' + pbs_fp, options)
+    if job_id is None:
+        job_id = '<array job id>'
+    elif len(job_id) == 0:
+        raise ValueError('qsub did not return a job id for the array job; the merge job was not submitted.')
+    run_qsub('qsub -W depend=afterokarray:%s %s' %(job_id, merge_fp), options)
+
+
 if __name__ == '__main__':
 	# make option parser and parse command line flags
     parser = make_option_parser()
@@ -86,31 +224,13 @@ if __name__ == '__main__':
             print('Output directory ' + options.out_basedir + ' not found. Creating it...')
         os.makedirs(options.out_basedir)
 
-    pbs_lines = []
-    pbs_lines.append('#!/bin/bash -l')
-    pbs_lines.append('#PBS -l walltime=%s,nodes=%d:ppn=%d,mem=%s' %(options.wallclock,options.nodes,options.ppn,options.mem))
+    if options.array_query is not None:
+        submit_array(options, stdout_fp, stderr_fp)
+        sys.exit(0)
 
-    if options.email is not None:
-        pbs_lines.append('#PBS -M %s' %(options.email))
-        pbs_lines.append('#PBS -m abe')
-    pbs_lines.append('#PBS -N %s' %(options.name))
-    pbs_lines.append('#PBS -o %s' %(stdout_fp))
-    pbs_lines.append('#PBS -e %s' %(stderr_fp))
-    pbs_lines.append('#PBS -q %s' %(options.queue))
+    pbs_lines = pbs_header(options, options.name, stdout_fp, stderr_fp)
     pbs_lines.append(options.command)
-
-    pbs_f = open(pbs_fp,'w')
-    pbs_f.write('\n'.join(pbs_lines) + '\n')
-    pbs_f.close()
+    write_pbs(pbs_fp, pbs_lines)
     
     cmd = 'qsub ' + pbs_fp
-    print('qsub command is: ' + cmd)
-    if not options.print_only:
-        print('Running qsub...')
-    
-        proc = Popen(cmd,shell=True,universal_newlines=True,stdout=PIPE,stderr=PIPE)
-        stdout, stderr = proc.communicate()
-        print(stdout)
-        if len(stderr) > 0:
-            print('\nStandard err was:\n' + stderr)
-
+    run_qsub(cmd, options)
@@ -1,11 +1,25 @@
 # usage:
-# 
+#
 # trim_fasta_by_primers.py -i in.fna -f fwd_primer -r rev_primer -o newfasta.fna -n 2
+# trim_fasta_by_primers.py -i in.fna -P V4f-EMP:V4r-EMP,V3f-Illumina:V4r-Illumina -d out_dir
 # -n is number of mismatches allowed
+# -P trims every listed primer pair (PRIMERS names or sequences) in the same
+# pass, writing one <input>-<fwd>-<rev>.fna file per region to -d
+# input and output may be compressed (.gz, .bz2 or .zst)
+#
+# primers are matched in-process (IUPAC codes allowed, up to -n
+# mismatches/indels) in one streaming pass over the input; each read is
+# trimmed to the region between its best forward and reverse primer matches
+# with -T, batches are trimmed by a pool of worker processes while this
+# process reads ahead at most 2 batches per worker and writes the results
+# in input order
 import sys, os
-import tempfile
-from subprocess import Popen, PIPE, STDOUT
+import multiprocessing
+from collections import deque
 from optparse import OptionParser
+import numpy as np
+from fasta_utils import read_fasta, open_output, WriterPool, strip_compression_ext
+from primer_utils import PrimerMatcher, encode_reads, length_groups, reverse_complement
 
 # note these are not reverse-comlemented
 PRIMERS = {}
@@ -20,7 +34,7 @@ def make_option_parser():
     parser.add_option("-i","--input_fasta",
                       default=None,
                       type='string',
-                      help="Path to input fasta_file [required]") 
+                      help="Path to input fasta_file [required]")
     parser.add_option("-f","--forward_primer",
                       default='GTGYCAGCMGCCGCGGTAA',
                       type='string',
@@ -33,14 +47,22 @@ def make_option_parser():
                       action="store_true",
                       default=False,
                       help="Reverse complement the reverse primer before matching (default %default)",)
-    parser.add_option("-c","--embalmer_command",
-                      default='embalm',
+    parser.add_option("-P","--primer_pairs",
+                      default=None,
+                      type='string',
+                      help="Comma-separated forward:reverse primer pairs to trim in one pass, each a PRIMERS name (reverse primers from the table are reverse-complemented) or a sequence (reverse sequences follow --reverse_complement); replaces -f/-r/-o. Names: " + ', '.join(sorted(PRIMERS)) + " [default %default]")
+    parser.add_option("-d","--output_dir",
+                      default='.',
                       type='string',
-                      help="Path to embalmer command [required]") 
+                      help="Output directory for --primer_pairs [default %default]")
+    parser.add_option("-s","--output_suffix",
+                      default='.fna',
+                      type='string',
+                      help="Suffix of the per-region output files for --primer_pairs, e.g. .fna.gz [default %default]")
     parser.add_option("-n","--n_mismatches",
                       default=1,
                       type='int',
-                      help="Number of primer mismatches allowed. [default %default]") 
+                      help="Number of primer mismatches (or inserted/deleted bases) allowed. [default %default]")
     parser.add_option("-p","--padding",
                       default=0,
                       type='int',
@@ -49,145 +71,178 @@ def make_option_parser():
                       default=25,
                       type='int',
                       help="Minimum trimmed sequence length. [default %default]")
-    parser.add_option("-T","--n_threads",
+    parser.add_option("-b","--batch_size",
+                      default=10000,
+                      type='int',
+                      help="Number of sequences matched at a time. [default %default]")
+    parser.add_option("-T","--processes",
                       default=1,
                       type='int',
-                      help="Number of concurrent threads for embalmer process [default %default]")
+                      help="Number of worker processes trimming batches in parallel. [default %default]")
     parser.add_option("-v","--verbose",
                       action="store_true",
                       default=False,
                       help="Verbose output (default %default)",)
-    parser.add_option("-d","--dont_delete",
-                      action="store_true",
-                      default=False,
-                      help="Don't delete temporary files (default %default)",)
     parser.add_option("-o","--output_fp",
                       type="string",
                       default=None,
-                      help="Path to output file [default os.path.splitext(os.path.basename(options.query))[0] + '-f<fwprimer>-r<reverseprimer>.fna']",)
+                      help="Path to output file [default os.path.splitext(os.path.basename(options.input_fasta))[0] + '-<fwprimer>-<reverseprimer>.fna']",)
     return parser
 
 
-def run_command(cmd, verbose=False):
-    if verbose:
-        print cmd
-    proc = Popen(cmd,shell=True,universal_newlines=True,stdout=PIPE,stderr=PIPE)
-    stdout, stderr = proc.communicate()
-    return_value = proc.returncode
-    return return_value, stdout, stderr
+def read_batches(input_fp, batch_size):
+    """yields lists of up to batch_size (header, seq) records"""
+    batch = []
+    for record in read_fasta(input_fp):
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def parse_primer_pairs(primer_pairs, reverse_complement_seqs=False):
+    """[(region name, forward primer, reverse primer as found in reads)] from
+    a comma-separated list of fwd:rev pairs of PRIMERS names or sequences"""
+    pairs = []
+    for pair in primer_pairs.split(','):
+        fwd, rev = pair.split(':')
+        fwd_seq = PRIMERS.get(fwd, fwd)
+        if rev in PRIMERS:
+            rev_seq = reverse_complement(PRIMERS[rev])
+        elif reverse_complement_seqs:
+            rev_seq = reverse_complement(rev)
+        else:
+            rev_seq = rev
+        pairs.append(('%s-%s' %(fwd, rev), fwd_seq, rev_seq))
+    return pairs
+
+
+def trim_batch(batch, pairs, matchers, min_length, padding):
+    """fasta text of the reads in batch trimmed to each primer pair's region
+
+    Returns one (text, number of reads) per pair. Reads are encoded once, in
+    groups of similar length, and each distinct primer is matched once,
+    whatever the number of pairs.
+    """
+    seqs = [seq for header, seq in batch]
+    matches = dict([(key, (np.empty(len(seqs), dtype=np.int64), np.empty(len(seqs), dtype=np.int64)))
+                    for key in matchers])
+    for group in length_groups([len(seq) for seq in seqs]):
+        group_seqs = [seqs[i] for i in group]
+        reads = encode_reads(group_seqs)
+        reversed_reads = encode_reads(group_seqs, reverse=True)
+        for key, matcher in matchers.items():
+            if matcher.reverse:
+                dists, positions = matcher.match(*reversed_reads)
+            else:
+                dists, positions = matcher.match(*reads)
+            matches[key][0][group] = dists
+            matches[key][1][group] = positions
+
+    results = []
+    for name, fwd, rev in pairs:
+        fwd_dists, starts = matches[(fwd, False)]
+        rev_dists, ends = matches[(rev, True)]
+        # if user requested padding, ensure it doesn't go past the primers
+        start_padding = min(len(fwd), padding)
+        end_padding = min(len(rev), padding)
+        # only keep reads whose region passes the minimum length threshold
+        keep = (fwd_dists >= 0) & (rev_dists >= 0) & (ends - starts >= min_length)
+        lines = []
+        for i in keep.nonzero()[0].tolist():
+            header, seq = batch[i]
+            startix = max(int(starts[i]) - start_padding, 0)
+            endix = min(int(ends[i]) + end_padding, len(seq))
+            lines.append('>' + header + '\n' + seq[startix:endix] + '\n')
+        results.append((''.join(lines), len(lines)))
+    return results
+
+
+def trim_worker(args):
+    """Pool worker: (number of reads, trim_batch results) for one batch"""
+    batch, pairs, matchers, min_length, padding = args
+    return len(batch), trim_batch(batch, pairs, matchers, min_length, padding)
+
+
+def trimmed_batches(input_fp, batch_size, pairs, matchers, min_length, padding, processes=1):
+    """yields trim_worker results for each batch of the input, in input order
+
+    With more than one process, at most 2 batches per process are read ahead
+    of the writer, so memory stays bounded however large the input is.
+    """
+    batches = read_batches(input_fp, batch_size)
+    if processes == 1:
+        for batch in batches:
+            yield trim_worker((batch, pairs, matchers, min_length, padding))
+        return
+    pool = multiprocessing.Pool(processes)
+    try:
+        pending = deque()
+        for batch in batches:
+            pending.append(pool.apply_async(trim_worker, ((batch, pairs, matchers, min_length, padding),)))
+            if len(pending) >= 2 * processes:
+                yield pending.popleft().get()
+        while len(pending) > 0:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
 
 
 if __name__ == '__main__':
     parser = make_option_parser()
     (options, args) = parser.parse_args()
 
-    if options.output_fp is None:
-        options.output_fp = os.path.splitext(os.path.basename(options.query))[0]
-        options.output_fp += '-%s-%s.fna' %(options.forward_primer, options.reverse_primer)
+    if options.primer_pairs is not None:
+        pairs = parse_primer_pairs(options.primer_pairs, options.reverse_complement)
+        base_fp = os.path.splitext(os.path.basename(strip_compression_ext(options.input_fasta)))[0]
+        if not os.path.isdir(options.output_dir):
+            os.makedirs(options.output_dir)
+        output_fps = dict([(name, os.path.join(options.output_dir, '%s-%s%s' %(base_fp, name, options.output_suffix)))
+                           for name, fwd, rev in pairs])
+    else:
+        if options.output_fp is None:
+            options.output_fp = os.path.splitext(os.path.basename(options.input_fasta))[0]
+            options.output_fp += '-%s-%s.fna' %(options.forward_primer, options.reverse_primer)
+        # RC the reverse primer if requested
+        reverse_primer = options.reverse_primer
+        if options.reverse_complement:
+            reverse_primer = reverse_complement(reverse_primer)
+        pairs = [(None, options.forward_primer, reverse_primer)]
+        output_fps = {None: options.output_fp}
     if options.verbose:
-        print "Output file is", options.output_fp
-
-
-    # write the primers to two different temporary FNA files
-    fwd_fp = tempfile.mkstemp()[1]
-    rev_fp = tempfile.mkstemp()[1]
-
-    fout = open(fwd_fp,'w')
-    fout.write('>Forward\n'+options.forward_primer + '\n')
-    fout.close()
-
-    fout = open(rev_fp,'w')
-    fout.write('>Reverse\n'+options.reverse_primer + '\n')
-    fout.close()
-
-    # RC the reverse primer if request (requires QIIME)
-    if options.reverse_complement:
-        rev_rc_fp =  tempfile.mkstemp()[1]
-        cmd = "adjust_seq_orientation.py -i " + rev_fp + " -o " + rev_rc_fp
-        ret, so, se = run_command(cmd, options.verbose)
-        if ret != 0:
-            print so
-            print se
-            raise ValueError("QIIME adjust_seq_orientation.py failed. Is QIIME installed?")
-        cmd = "mv " + rev_rc_fp + " " + rev_fp
-        ret, so, se = run_command(cmd, options.verbose)
-
-    # Match each primer against each input sequence
-    fwd_hits_fp = tempfile.mkstemp()[1]
-    rev_hits_fp = tempfile.mkstemp()[1]
-    cmd_parts = [options.embalmer_command, '--forage', options.input_fasta, fwd_fp, fwd_hits_fp]
-    cmd_parts += [str(1 - float(options.n_mismatches)/len(options.forward_primer)), str(options.n_threads)]
-    if options.verbose:
-        print "Aligning forward primer to input sequences..."
-    ret, so, se = run_command(' '.join(cmd_parts), options.verbose)
-    if ret != 0:
-            print so
-            print se
-            raise ValueError("embalmer alignment of forward primer failed. Is embalmer installed?")
-
-    cmd_parts = [options.embalmer_command, '--forage', options.input_fasta, rev_fp, rev_hits_fp]
-    cmd_parts += [str(1 - float(options.n_mismatches)/len(options.reverse_primer)), str(options.n_threads)]
-    if options.verbose:
-        print "Aligning reverse primer to input sequences..."
-    ret, so, se = run_command(' '.join(cmd_parts), options.verbose)
-    if ret != 0:
-            print so
-            print se
-            raise ValueError("embalmer alignment of reverse primer failed. Is embalmer installed?")
-
-
-    # read start/end of each sequence from primer hits
-    starts = {} # {seqid:start}
-    ends = {} # {seqid:end}
-    pos = {}  # {seqid:[start,end]}
-    for line in open(fwd_hits_fp,'U'):
-        line = line.strip()
-        words = line.split('\t')
-        refID = words[1].split()[0]
-        starts[refID] = int(words[9])
-
-    for line in open(rev_hits_fp,'U'):
-        line = line.strip()
-        words = line.split('\t')
-        refID = words[1].split()[0]
-        ends[refID] = int(words[8])
-
-    # get intersection
-    for key in starts:
-        if ends.has_key(key):
-            # only add this sequence if it passes the minimum length threshold
-            if ends[key] - starts[key] > options.min_length:
-                pos[key] = [starts[key],ends[key]]
-    if len(pos) == 0:
-        raise ValueError("Error: There are were no valid alignments. Does reverse primer need to be reverse-complemented?")
+        print "Output files are", ', '.join(sorted(output_fps.values()))
+
+    # the forward primer's match ends where the region starts; the reverse
+    # primer is matched on the reversed reads to find where its match starts
+    matchers = {}
+    for name, fwd, rev in pairs:
+        matchers[(fwd, False)] = PrimerMatcher(fwd, options.n_mismatches)
+        matchers[(rev, True)] = PrimerMatcher(rev, options.n_mismatches, reverse=True)
 
-    # trim fasta
     if options.verbose:
-        print "Trimming input fasta file..."
-    outf = open(options.output_fp,'w')
-    header = ''
-    seqid = ''
-
-    # if user requested padding, ensure it doesn't go past the primers
-    start_padding = min(len(options.forward_primer), options.padding)
-    end_padding = min(len(options.reverse_primer), options.padding)
-
-    for line in open(options.input_fasta,'U'):
-        line = line.strip()
-        if line.startswith('>'):
-            header = line
-            seqid = line.split()[0][1:]
-        else:
-            if pos.has_key(seqid):
-                startix = pos[seqid][0]-1
-                endix = pos[seqid][1]-1
-                outf.write(header + '\n')
-                startix = max(startix - start_padding, 0)
-                endix = min(endix + end_padding, len(line))
-                outf.write(line[startix:endix] + '\n')
-    outf.close()
-
-    to_remove = [fwd_fp, fwd_hits_fp, rev_fp, rev_hits_fp]
-    if not options.dont_delete:
-        for f in to_remove:
-            os.remove(f)
+        print "Matching primers and trimming input fasta file..."
+    writers = WriterPool(output_fps)
+    nseqs = 0
+    ntrimmed = dict([(name, 0) for name, fwd, rev in pairs])
+    for batch_nseqs, results in trimmed_batches(options.input_fasta, options.batch_size, pairs, matchers,
+                                                 options.min_length, options.padding, options.processes):
+        for (name, fwd, rev), (text, count) in zip(pairs, results):
+            if count > 0:
+                writers.write(name, text)
+            ntrimmed[name] += count
+        nseqs += batch_nseqs
+        if options.verbose:
+            print nseqs, "sequences read,", sum(ntrimmed.values()), "trimmed"
+    writers.close()
+    for name in output_fps:
+        if name not in writers.started:
+            open_output(output_fps[name]).close()
+    if options.verbose and options.primer_pairs is not None:
+        for name, fwd, rev in pairs:
+            print name + ':', ntrimmed[name], "trimmed"
+
+    if sum(ntrimmed.values()) == 0:
+        raise ValueError("Error: There are were no valid alignments. Does reverse primer need to be reverse-complemented?")